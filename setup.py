@@ -40,4 +40,7 @@ setuptools.setup(
 		'nerdfonts',
 		'requests',
 	],
+	extras_require = {
+		'fast': ['orjson'],
+	},
 )
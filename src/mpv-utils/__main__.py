@@ -1,9 +1,12 @@
+import os.path
 import re
 import threading
 import time
 
+from chat_file import ChatFile
 from config import Config
 import _logging as logging
+from metrics import MetricsExporter
 from mpv import MPV
 from printer import TwitchChatPrinter
 from twitch_chat import TwitchChat
@@ -20,16 +23,22 @@ def main():
 	config = Config()
 	config.apply()
 
+	# Export metrics, if enabled.
+	exporter = MetricsExporter.open()
+	if exporter:
+		exporter.start()
+
 	# Connect to MPV.
 	mpv = MPV()
 	mpv.start()
+	mpv.mirror('playback-time')
 
 	# Listen to changes in the file that is being played.
 	previous_path = None
 	printer = None
-	twitch = None
+	chat = None
 	def path_change(path):
-		nonlocal previous_path, printer, twitch
+		nonlocal previous_path, printer, chat
 
 		log.debug(f'Path change from {previous_path} to {path}.')
 		if path == previous_path:
@@ -39,21 +48,30 @@ def main():
 		if printer:
 			printer.stop()
 			printer.join()
-		if twitch:
-			twitch.stop()
-			twitch.join()
+		if chat:
+			chat.stop()
+			chat.join()
+			chat = None
+		if not path:
+			return
 
 		match = TWITCH_VOD_RE.match(path)
-		if not match:
-			log.info('Current video is not a twitch vod, no chat to show.')
-			return
+		if match:
+			log.info(f'New twitch vod started ({path}), showing chat.')
+			vod_id = match.group('id')
+			position = int(float(mpv.get_property('playback-time')))
+			chat = TwitchChat(vod_id, start = position)
+		else:
+			# Relative paths are relative to the working directory of MPV, which need not be ours.
+			chat_path = ChatFile.find(os.path.join(mpv.get_property('working-directory'), path))
+			if not chat_path:
+				log.info('Current video is not a twitch vod and has no chat file, no chat to show.')
+				return
+			log.info(f'New video with chat file started ({path}), showing chat from {chat_path}.')
+			chat = ChatFile(chat_path)
 
-		log.info(f'New twitch vod started ({path}), showing chat.')
-		vod_id = match.group('id')
-		position = int(float(mpv.command('get_property', 'playback-time')))
-		twitch = TwitchChat(vod_id, start = position)
-		twitch.start()
-		printer = TwitchChatPrinter(mpv, twitch)
+		chat.start()
+		printer = TwitchChatPrinter(mpv, chat)
 		printer.start()
 	mpv.observe('path', path_change, request_initial = True)
 
@@ -66,13 +84,17 @@ def main():
 			print('Stopping printer...')
 			printer.stop()
 			printer.join()
-		if twitch:
+		if chat:
 			print('Stopping chat fetcher...')
-			twitch.stop()
-			twitch.join()
+			chat.stop()
+			chat.join()
 		print('Stopping mpv wrapper...')
 		mpv.stop()
 		mpv.join()
+		if exporter:
+			print('Stopping metrics exporter...')
+			exporter.stop()
+			exporter.join()
 
 
 if __name__ == '__main__':
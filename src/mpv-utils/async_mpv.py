@@ -0,0 +1,197 @@
+import asyncio
+
+import _logging as logging
+from mpv import BaseMPV, MPVError, json_loads
+
+
+class AsyncCommandFuture(asyncio.Future):
+	""" An asyncio Future that resolves to the response of an MPV IPC command. """
+	def __init__(self, request_id):
+		super(AsyncCommandFuture, self).__init__()
+		self.request_id = request_id
+
+
+class Subscription(object):
+	"""
+	An async iterator over the values passed to a handler.
+
+	Values are queued from the moment the subscription is created, so nothing is missed between subscribing and starting
+	to iterate. Use close (or use the subscription as an async context manager) to stop listening. Iteration ends once
+	the subscription is closed or the connection to MPV is lost, after the values queued before that.
+	"""
+
+	# Queued to mark the end of the values.
+	END = object()
+
+	def __init__(self):
+		self.queue = asyncio.Queue()
+		self.unsubscribers = []
+		self.ended = False
+
+	def put(self, value):
+		if not self.ended:
+			self.queue.put_nowait(value)
+
+	def end(self):
+		""" End the iteration, without unsubscribing. """
+		if not self.ended:
+			self.queue.put_nowait(Subscription.END)
+			self.ended = True
+
+	def close(self):
+		while self.unsubscribers:
+			self.unsubscribers.pop()()
+		self.end()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		value = await self.queue.get()
+		if value is Subscription.END:
+			# Keep the marker around, so that later calls end as well.
+			self.queue.put_nowait(value)
+			raise StopAsyncIteration()
+		return value
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *args):
+		self.close()
+
+
+class AsyncMPV(BaseMPV):
+	"""
+	Integration with MPV over the IPC socket, using asyncio.
+
+	This provides the same interface as MPV, except that everything that talks to MPV is a coroutine. Handlers and
+	observers are invoked on the event loop, so they should not block.
+	"""
+
+	# The maximum length of a single message received from MPV.
+	MESSAGE_LIMIT = 16 * 1024 * 1024
+
+	def __init__(self):
+		super(AsyncMPV, self).__init__()
+
+		self.log = logging.getLogger(__name__, AsyncMPV)
+
+		self.reader = None
+		self.writer = None
+		self.reader_task = None
+		self.subscriptions = set()
+
+	async def connect(self):
+		self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path, limit = AsyncMPV.MESSAGE_LIMIT)
+		self.reader_task = asyncio.ensure_future(self._process())
+
+	async def close(self):
+		if self.writer:
+			self.writer.close()
+			self.writer = None
+		if self.reader_task:
+			await self.reader_task
+
+	async def __aenter__(self):
+		await self.connect()
+		return self
+
+	async def __aexit__(self, *args):
+		await self.close()
+
+	async def _process(self):
+		try:
+			while True:
+				line = await self.reader.readline()
+				if not line:
+					self.log.warn('Connection closed by MPV')
+					break
+				self._process_message(json_loads(line))
+		except Exception as e:
+			self.log.exception(e)
+		finally:
+			# Nothing will be received anymore, so fail everything that is still waiting for a response.
+			with self.listener_lock:
+				listeners = list(self.listeners.values())
+				self.listeners.clear()
+			for listener in listeners:
+				self._resolve_request(listener, error = MPVError('Connection closed'))
+			# Nothing will be received for the subscriptions anymore either.
+			for subscription in list(self.subscriptions):
+				subscription.end()
+
+	async def command(self, command, *args):
+		""" Send a command to MPV, and wait for a response. """
+		return await self.wait(self.command_batch((command, *args))[0])
+
+	def command_batch(self, *commands):
+		""" Send multiple commands to MPV in a single write, and return a list of AsyncCommandFutures for the responses. """
+		if self.writer is None:
+			raise MPVError('Not connected')
+		futures, data = self._create_requests(commands, AsyncCommandFuture)
+		self.log.debug(f'Sending message: {data}')
+		self.writer.write(data)
+		return futures
+
+	async def wait(self, future, timeout = None):
+		""" Wait for the response to a command sent with command_batch. """
+		try:
+			return await asyncio.wait_for(future, timeout or AsyncMPV.COMMAND_TIMEOUT)
+		except asyncio.TimeoutError:
+			self.log.error(f'Timeout while waiting for a response to request {future.request_id}')
+			self._forget_request(future.request_id)
+			raise MPVError('No response received')
+
+	def _resolve_request(self, future, result = None, error = None):
+		if future.cancelled():
+			self.log.debug(f'Dropping response for cancelled request {future.request_id}')
+		elif error:
+			future.set_exception(error)
+		else:
+			future.set_result(result)
+
+	def events(self, *events):
+		""" Get a Subscription that yields the messages of the given MPV events. """
+		subscription = self._create_subscription()
+		for event in events:
+			subscription.unsubscribers.append(self.on(event, subscription.put))
+		return subscription
+
+	async def observe(self, prop, handler, request_initial = False):
+		""" Listen to changes to an MPV property. """
+		observer_id = self._add_observer(prop, handler)
+		if observer_id is not None:
+			# First observer of this property, so start listening
+			await self.command('observe_property', observer_id, prop)
+		if request_initial:
+			handler(await self.command('get_property', prop))
+		return lambda: self.unobserve(prop, handler)
+
+	async def unobserve(self, prop, handler):
+		""" Stop listening to changes to an MPV property. """
+		observer_id = self._remove_observer(prop, handler)
+		if observer_id is not None:
+			# Last observer of this property, so stop listening
+			await self.command('unobserve-property', observer_id)
+
+	async def property_changes(self, prop, request_initial = False):
+		""" Get a Subscription that yields the values of an MPV property whenever it changes. """
+		subscription = self._create_subscription()
+		await self.observe(prop, subscription.put, request_initial = request_initial)
+		subscription.unsubscribers.append(lambda: asyncio.ensure_future(self._unobserve_quietly(prop, subscription.put)))
+		return subscription
+
+	def _create_subscription(self):
+		""" Create a Subscription that is ended when the connection is lost. """
+		subscription = Subscription()
+		self.subscriptions.add(subscription)
+		subscription.unsubscribers.append(lambda: self.subscriptions.discard(subscription))
+		return subscription
+
+	async def _unobserve_quietly(self, prop, handler):
+		""" Stop listening to changes to an MPV property, logging rather than raising errors. """
+		try:
+			await self.unobserve(prop, handler)
+		except MPVError as e:
+			self.log.warn(f'Unable to stop observing property {prop}: {e}')
@@ -0,0 +1,170 @@
+"""
+Benchmarks for the MPV IPC client, against a local stand-in for MPV.
+
+Run with `python benchmark.py --help` for the available options.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from mpv import MPV
+
+
+class FakeMPV(object):
+	"""
+	A minimal stand-in for the IPC server of MPV.
+
+	This answers get_property, observe_property and unobserve_property commands, optionally after a delay. It also
+	understands the benchmark-storm command, which makes it send a configurable amount of property-change events for the
+	observed properties. Each event has the time.monotonic() at which it was sent as data, so the time it takes for the
+	event to reach a handler can be measured.
+	"""
+
+	def __init__(self, path, reply_delay = 0):
+		self.path = path
+		self.reply_delay = reply_delay
+		self.properties = {
+			'pause': False,
+			'playback-time': 0.0,
+			'speed': 1.0,
+		}
+
+	def serve(self, ready):
+		with socket.socket(socket.AF_UNIX) as server:
+			server.bind(self.path)
+			server.listen()
+			ready.set()
+			while True:
+				client, _ = server.accept()
+				threading.Thread(target = self._handle_client, args = (client,), daemon = True).start()
+
+	def _handle_client(self, client):
+		observed = {}
+		send_lock = threading.Lock()
+
+		def send(message):
+			with send_lock:
+				client.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+		with client, client.makefile('rb') as lines:
+			for line in lines:
+				message = json.loads(line)
+				command, *args = message['command']
+				response = { 'request_id': message['request_id'], 'error': 'success' }
+				if command == 'get_property':
+					response['data'] = self.properties.get(args[0])
+				elif command == 'observe_property':
+					observed[args[0]] = args[1]
+				elif command in ('unobserve_property', 'unobserve-property'):
+					observed = { k: v for k, v in observed.items() if k != args[0] }
+				elif command == 'benchmark-storm':
+					threading.Thread(target = self._storm, args = (send, dict(observed), *args), daemon = True).start()
+				else:
+					response['error'] = 'invalid parameter'
+
+				if self.reply_delay:
+					time.sleep(self.reply_delay)
+				send(response)
+
+	def _storm(self, send, observed, count, rate):
+		interval = 1 / rate if rate else 0
+		start = time.monotonic()
+		for i in range(count):
+			if interval:
+				delay = start + i * interval - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+			for observer_id, name in observed.items():
+				send({ 'event': 'property-change', 'id': observer_id, 'name': name, 'data': time.monotonic() })
+
+
+def percentiles(values, *points):
+	""" Get the given percentiles (0-100) of the values. """
+	values = sorted(values)
+	return [values[min(len(values) - 1, int(len(values) * point / 100))] for point in points]
+
+
+def format_latencies(values):
+	p50, p90, p99 = percentiles(values, 50, 90, 99)
+	return f'p50 {p50 * 1000:.3f}ms, p90 {p90 * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms, max {max(values) * 1000:.3f}ms'
+
+
+def benchmark_commands(mpv, count):
+	""" Measure the round trip time of sequential commands. """
+	timings = []
+	for _ in range(count):
+		start = time.perf_counter()
+		mpv.command('get_property', 'playback-time')
+		timings.append(time.perf_counter() - start)
+	print(f'Command round trip ({count} commands): {format_latencies(timings)}')
+
+
+def benchmark_events(mpv, count, rate):
+	""" Measure the throughput, dispatch latency and CPU usage of property-change events. """
+	latencies = []
+	done = threading.Event()
+
+	def handler(sent):
+		latencies.append(time.monotonic() - sent)
+		if len(latencies) == count:
+			done.set()
+
+	mpv.observe('benchmark', handler)
+	start_time = time.perf_counter()
+	start_cpu = time.process_time()
+	mpv.command('benchmark-storm', count, rate)
+	if not done.wait(max(60, count / rate * 2 if rate else 0)):
+		print(f'Timeout: only {len(latencies)} of {count} events arrived')
+	elapsed = time.perf_counter() - start_time
+	cpu = time.process_time() - start_cpu
+	mpv.unobserve('benchmark', handler)
+
+	description = f'{count} events at {rate}/s' if rate else f'{count} events, unthrottled'
+	print(f'Events ({description}):')
+	print(f'  Throughput: {len(latencies) / elapsed:.0f} events/s')
+	print(f'  Dispatch latency: {format_latencies(latencies)}')
+	print(f'  CPU per event: {cpu / max(1, len(latencies)) * 1e6:.1f}us')
+
+
+def main():
+	parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+	parser.add_argument('--commands', type = int, default = 2000, help = 'number of commands for the round trip test')
+	parser.add_argument('--events', type = int, default = 50000, help = 'number of events for the throughput test')
+	parser.add_argument('--event-rate', type = int, default = 2000, help = 'events per second for the latency test')
+	parser.add_argument('--reply-delay', type = float, default = 0, help = 'seconds the fake MPV waits before replying')
+	parser.add_argument('--read-size', type = int, default = 65536, help = 'socket_read_size to use')
+	args = parser.parse_args()
+
+	# The debug logging would otherwise dominate the results.
+	logging.getLogger().setLevel(logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'mpv.sock')
+		ready = multiprocessing.Event()
+		server = multiprocessing.Process(target = FakeMPV(path, args.reply_delay).serve, args = (ready,), daemon = True)
+		server.start()
+		ready.wait()
+
+		MPV.socket_path = path
+		MPV.socket_read_size = args.read_size
+		mpv = MPV()
+		mpv.start()
+		try:
+			benchmark_commands(mpv, args.commands)
+			benchmark_events(mpv, args.events, 0)
+			benchmark_events(mpv, min(args.events, args.event_rate * 5), args.event_rate)
+		finally:
+			mpv.stop()
+			mpv.join()
+			server.terminate()
+
+
+if __name__ == '__main__':
+	main()
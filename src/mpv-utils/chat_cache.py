@@ -0,0 +1,170 @@
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+
+from config import Configurable
+import _logging as logging
+
+
+if sys.platform in 'win32':
+	CACHE_PATH = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+else:
+	CACHE_PATH = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+CACHE_PATH = os.path.join(CACHE_PATH, 'mpv-utils', 'chat.sqlite')
+
+SCHEMA = '''
+	CREATE TABLE IF NOT EXISTS vods (
+		vodid TEXT PRIMARY KEY,
+		size INTEGER NOT NULL DEFAULT 0,
+		last_used REAL NOT NULL
+	);
+	CREATE TABLE IF NOT EXISTS comments (
+		vodid TEXT NOT NULL,
+		id TEXT NOT NULL,
+		offset REAL NOT NULL,
+		data BLOB NOT NULL,
+		PRIMARY KEY (vodid, id)
+	);
+	CREATE INDEX IF NOT EXISTS comments_offset ON comments (vodid, offset);
+	CREATE TABLE IF NOT EXISTS ranges (
+		vodid TEXT NOT NULL,
+		start REAL NOT NULL,
+		end REAL
+	);
+	CREATE INDEX IF NOT EXISTS ranges_vodid ON ranges (vodid, start);
+'''
+
+
+class ChatCache(Configurable):
+	"""
+	A persistent cache of Twitch chat comments, shared by all VODs.
+
+	For each VOD this stores the comments that have been fetched, as well as the time ranges for which all comments have
+	been fetched. A range with an end of None stretches to the end of the VOD. Ranges are start-inclusive and
+	end-exclusive, and overlapping or adjacent ranges are merged.
+
+	When the cache grows beyond the configured size, the least recently used VODs are evicted, and VODs that have not been
+	used for longer than the configured age are evicted as well.
+	"""
+
+	def __init__(self, path = None):
+		self.log = logging.getLogger(__name__, ChatCache)
+
+		path = path or CACHE_PATH
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread = False)
+		with self.lock, self.db:
+			self.db.executescript(SCHEMA)
+
+	@classmethod
+	def configure(cls, config):
+		cls.enabled = config.get_bool('twitch', 'cache')
+		cls.max_size = config.get_int('twitch', 'cache_max_size') * 1024 * 1024
+		cls.max_age = config.get_float('twitch', 'cache_max_age') * 24 * 60 * 60
+
+	@classmethod
+	def open(cls):
+		""" Get a cache instance if the cache is enabled, or None otherwise. """
+		if not cls.enabled:
+			return None
+		return cls()
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def get(self, vodid, position, limit):
+		"""
+		Get cached comments starting at the given position, if the position is within a cached range.
+
+		Returns None if the position is not cached. Otherwise returns a tuple of the comments (at most limit, starting at
+		the given position), the position up to which comments have been returned, and whether the returned comments
+		reach the end of the VOD.
+		"""
+		with self.lock, self.db:
+			row = self.db.execute(
+				'SELECT end FROM ranges WHERE vodid = ? AND start <= ? AND (end IS NULL OR end > ?)',
+				(vodid, position, position),
+			).fetchone()
+			if row is None:
+				return None
+			end = row[0]
+
+			rows = self.db.execute(
+				'SELECT offset, data FROM comments WHERE vodid = ? AND offset >= ? AND (? IS NULL OR offset < ?) '
+				'ORDER BY offset, rowid LIMIT ?',
+				(vodid, position, end, end, limit),
+			).fetchall()
+			self.db.execute('UPDATE vods SET last_used = ? WHERE vodid = ?', (time.time(), vodid))
+
+		comments = [json.loads(data) for _, data in rows]
+		if len(rows) == limit:
+			# There might be more comments in the range, so we can only claim to have returned everything up to the
+			# last comment.
+			return (comments, rows[-1][0], False)
+		elif end is None:
+			return (comments, float('inf'), True)
+		else:
+			return (comments, end, False)
+
+	def store(self, vodid, start, end, comments):
+		"""
+		Store comments that were fetched for a range.
+
+		The range must be complete, that is, there must be no comments within it that are not in the list. Use None as
+		end if the comments reach the end of the VOD.
+		"""
+		size = 0
+		with self.lock, self.db:
+			for comment in comments:
+				data = json.dumps(comment, separators = (',', ':'))
+				cursor = self.db.execute(
+					'INSERT OR IGNORE INTO comments (vodid, id, offset, data) VALUES (?, ?, ?, ?)',
+					(vodid, comment['_id'], comment['content_offset_seconds'], data),
+				)
+				if cursor.rowcount:
+					size += len(data)
+			self.db.execute(
+				'INSERT INTO vods (vodid, size, last_used) VALUES (?, ?, ?) '
+				'ON CONFLICT (vodid) DO UPDATE SET size = size + excluded.size, last_used = excluded.last_used',
+				(vodid, size, time.time()),
+			)
+			self._add_range(vodid, start, end)
+			self._evict()
+
+	def _add_range(self, vodid, start, end):
+		""" Add a range, merging it with all ranges it overlaps with or is adjacent to. """
+		overlapping = self.db.execute(
+			'SELECT rowid, start, end FROM ranges WHERE vodid = ? AND (? IS NULL OR start <= ?) AND (end IS NULL OR end >= ?)',
+			(vodid, end, end, start),
+		).fetchall()
+		for _, other_start, other_end in overlapping:
+			start = min(start, other_start)
+			end = None if end is None or other_end is None else max(end, other_end)
+		self.db.executemany('DELETE FROM ranges WHERE rowid = ?', [(rowid,) for rowid, _, _ in overlapping])
+		self.db.execute('INSERT INTO ranges (vodid, start, end) VALUES (?, ?, ?)', (vodid, start, end))
+
+	def _evict(self):
+		""" Evict VODs that are too old, and then the least recently used VODs until the cache is small enough. """
+		evict = [row[0] for row in self.db.execute(
+			'SELECT vodid FROM vods WHERE last_used < ?',
+			(time.time() - self.max_age,),
+		)]
+		# The most recently used VOD is always kept, even if it is bigger than the maximum size on its own.
+		total_size = 0
+		for i, (vodid, size) in enumerate(self.db.execute('SELECT vodid, size FROM vods ORDER BY last_used DESC')):
+			if vodid in evict:
+				continue
+			total_size += size
+			if total_size > self.max_size and i > 0:
+				evict.append(vodid)
+
+		for vodid in evict:
+			self.log.info(f'Evicting chat of VOD {vodid} from the cache')
+			for table in ('vods', 'comments', 'ranges'):
+				self.db.execute(f'DELETE FROM {table} WHERE vodid = ?', (vodid,))
@@ -0,0 +1,301 @@
+from array import array
+from bisect import bisect_left
+import json
+import mmap
+import os
+import os.path
+import re
+import struct
+import threading
+
+import _logging as logging
+from twitch_chat import MessageStore
+from utils import format_timestamp
+
+
+class ChatFile(threading.Thread):
+	"""
+	The chat for a local video, read from a chat file next to it.
+
+	The chat file contains the comments in the format used by the Twitch API, either as a JSON document (a list of
+	comments, or an object with the list under the comments key), or as newline delimited JSON (one comment per line).
+	The comments are assumed to be in chronological order.
+
+	The file is memory-mapped, and an index with the position of the first comment of each second is built in the
+	background. Messages are only parsed when they are requested. The index is saved next to the chat file, so that it
+	only has to be built once. Requests for seconds that have not been indexed yet wait until they have been.
+
+	This has the same interface as TwitchChat.
+	"""
+
+	# The extensions (added to the path of the video without its extension) to look for chat files with, in order.
+	EXTENSIONS = ('.chat.ndjson', '.chat.json', '.ndjson', '.json')
+
+	# The extension (added to the path of the chat file) of the index.
+	INDEX_EXTENSION = '.index'
+	INDEX_MAGIC = b'MPVUCHAT'
+	INDEX_VERSION = 1
+	INDEX_HEADER = struct.Struct('<8sIQQQ')
+
+	# The maximum length of a line in a newline delimited JSON file. Used to avoid parsing an entire JSON document when
+	# checking whether a file is newline delimited.
+	MAX_LINE_LENGTH = 1024 * 1024
+
+	# Notify waiting requests after indexing this many seconds.
+	NOTIFY_INTERVAL = 60
+
+	# Matches the offset of a comment. The lookbehind prevents matching the key when it is (escaped) inside a string.
+	OFFSET_RE = re.compile(rb'(?<!\\)"content_offset_seconds"\s*:\s*(-?[0-9.eE+-]+)')
+
+	# Matches strings and the tokens that change the nesting depth, to find the comments in a JSON document.
+	TOKEN_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+	def __init__(self, path):
+		super(ChatFile, self).__init__()
+
+		self.log = logging.getLogger(__name__, ChatFile, os.path.basename(path))
+
+		self.path = path
+		self.index_path = path + ChatFile.INDEX_EXTENSION
+		self.stop_requested = threading.Event()
+
+		# The seconds that have messages, in ascending order, and the offset of the first message of each. There is one
+		# more offset than there are seconds, which is the end of the last message. Seconds before indexed_until are
+		# completely indexed.
+		self.lock = threading.Lock()
+		self.indexed = threading.Condition(self.lock)
+		self.seconds = array('q')
+		self.offsets = array('Q')
+		self.indexed_until = float('-inf')
+
+		self.file = None
+		self.map = None
+		self.is_ndjson = False
+
+	@classmethod
+	def find(cls, video_path):
+		""" Find the chat file for a video, returning None if there is none. """
+		if not os.path.isfile(video_path):
+			return None
+		base = os.path.splitext(video_path)[0]
+		for extension in ChatFile.EXTENSIONS:
+			path = base + extension
+			if os.path.isfile(path):
+				return path
+		return None
+
+	def stop(self):
+		self.stop_requested.set()
+		with self.indexed:
+			self.indexed.notify_all()
+
+	def run(self):
+		try:
+			self._run()
+		except Exception as e:
+			self.log.exception(e)
+		finally:
+			# Nothing will be indexed anymore, so don't let requests wait for it.
+			with self.indexed:
+				self.indexed_until = float('inf')
+				self.indexed.notify_all()
+
+		# Keep the file open until we're stopped, as messages are read from it on demand.
+		self.stop_requested.wait()
+		self._close()
+
+	def _run(self):
+		self.file = open(self.path, 'rb')
+		if os.fstat(self.file.fileno()).st_size == 0:
+			self.log.warn('Chat file is empty')
+			return
+		self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		self.is_ndjson = self._detect_ndjson()
+
+		if self._load_index():
+			self.log.info(f'Loaded index of {len(self.seconds)} seconds')
+			return
+
+		self.log.info('Building index')
+		if self.is_ndjson:
+			complete = self._build_index(self._scan_lines())
+		else:
+			complete = self._build_index(self._scan_document())
+		if complete:
+			self.log.info(f'Built index of {len(self.seconds)} seconds')
+			self._save_index()
+
+	def _close(self):
+		if self.map:
+			self.map.close()
+		if self.file:
+			self.file.close()
+
+	def __getitem__(self, timestamp):
+		with self.indexed:
+			self._wait_for_index(timestamp)
+			i = bisect_left(self.seconds, timestamp)
+			if i == len(self.seconds) or self.seconds[i] != timestamp:
+				return []
+			start, end = self.offsets[i], self.offsets[i + 1]
+		return self._read(start, end)
+
+	def iter_from(self, timestamp):
+		""" Iterate over the messages from the given second onwards, in order. See TwitchChat.iter_from. """
+		second = int(timestamp)
+		while True:
+			with self.indexed:
+				self._wait_for_index(second)
+				if self.stop_requested.is_set():
+					return
+				i = bisect_left(self.seconds, second)
+				if i == len(self.seconds) or self.seconds[i] >= self.indexed_until:
+					if self.indexed_until == float('inf'):
+						return
+					# Everything that has been indexed so far is before the given second, so wait for more.
+					second = self.indexed_until
+					continue
+				start, end = self.offsets[i], self.offsets[i + 1]
+				second = self.seconds[i] + 1
+			yield from self._read(start, end)
+
+	def _wait_for_index(self, second):
+		""" Wait until the given second has been indexed. Must be called while holding the lock. """
+		if second >= self.indexed_until:
+			self.log.debug(f'Waiting for requested timestamp ({format_timestamp(second)}) to be indexed')
+			self.indexed.wait_for(lambda: second < self.indexed_until or self.stop_requested.is_set())
+
+	def _read(self, start, end):
+		""" Read the messages in a range of the file. """
+		if self.stop_requested.is_set():
+			return []
+		messages = MessageStore()
+		for comment in self._parse(self.map[start:end]):
+			messages.append(MessageStore.prepare(comment))
+		return messages[:]
+
+	def _parse(self, data):
+		""" Parse the comments in a range of the file. """
+		if self.is_ndjson:
+			return [json.loads(line) for line in data.splitlines() if line.strip()]
+		# The range is a part of a list, so it consists of comments separated by commas.
+		return json.loads(b'[' + data.strip(b' \t\r\n,') + b']')
+
+	def _detect_ndjson(self):
+		""" Whether the file is newline delimited JSON, based on whether the first line is a complete comment. """
+		end = self.map.find(b'\n', 0, ChatFile.MAX_LINE_LENGTH)
+		if end < 0:
+			end = len(self.map)
+		if end > ChatFile.MAX_LINE_LENGTH:
+			return False
+		try:
+			first = json.loads(self.map[:end])
+		except ValueError:
+			return False
+		return isinstance(first, dict) and 'content_offset_seconds' in first
+
+	def _scan_lines(self):
+		""" Yield the start, end and offset of each comment in a newline delimited JSON file. """
+		position = 0
+		while position < len(self.map):
+			end = self.map.find(b'\n', position)
+			if end < 0:
+				end = len(self.map)
+			match = ChatFile.OFFSET_RE.search(self.map, position, end)
+			if match:
+				yield (position, end, float(match.group(1)))
+			position = end + 1
+
+	def _scan_document(self):
+		""" Yield the start, end and offset of each comment in a JSON document. """
+		depth = 0
+		# The depth of the list with comments, once it has been found.
+		list_depth = None
+		previous = None
+		start = None
+		for match in ChatFile.TOKEN_RE.finditer(self.map):
+			token = match.group()
+			if token in (b'{', b'['):
+				depth += 1
+				if list_depth is None and token == b'[' and (depth == 1 or previous == b'"comments"' and depth == 2):
+					list_depth = depth
+				elif list_depth is not None and token == b'{' and depth == list_depth + 1:
+					start = match.start()
+			elif token in (b'}', b']'):
+				depth -= 1
+				if list_depth is not None and depth == list_depth and start is not None:
+					offset = ChatFile.OFFSET_RE.search(self.map, start, match.end())
+					if offset:
+						yield (start, match.end(), float(offset.group(1)))
+					start = None
+				elif list_depth is not None and depth < list_depth:
+					return
+			previous = token
+			if self.stop_requested.is_set():
+				return
+
+	def _build_index(self, comments):
+		""" Build the index from the start, end and offset of each comment. Returns whether the index is complete. """
+		end = 0
+		for start, end, offset in comments:
+			second = int(offset)
+			# Comments should be in chronological order, but if one isn't, just count it as part of the last second.
+			if not self.seconds or second > self.seconds[-1]:
+				with self.indexed:
+					self.seconds.append(second)
+					self.offsets.append(start)
+					self.indexed_until = second
+					if len(self.seconds) % ChatFile.NOTIFY_INTERVAL == 0:
+						self.indexed.notify_all()
+			if self.stop_requested.is_set():
+				return False
+		with self.indexed:
+			self.offsets.append(end)
+			self.indexed_until = float('inf')
+			self.indexed.notify_all()
+		return True
+
+	def _get_source_stat(self):
+		stat = os.fstat(self.file.fileno())
+		return (stat.st_size, stat.st_mtime_ns)
+
+	def _load_index(self):
+		""" Load the saved index, if there is one that is up to date. Returns whether this succeeded. """
+		try:
+			with open(self.index_path, 'rb') as f:
+				magic, version, size, mtime, count = ChatFile.INDEX_HEADER.unpack(f.read(ChatFile.INDEX_HEADER.size))
+				if (magic, version) != (ChatFile.INDEX_MAGIC, ChatFile.INDEX_VERSION):
+					return False
+				if (size, mtime) != self._get_source_stat():
+					self.log.info('Chat file has changed since the index was built')
+					return False
+				seconds = array('q')
+				offsets = array('Q')
+				seconds.fromfile(f, count)
+				offsets.fromfile(f, count + 1)
+		except (OSError, EOFError, struct.error) as e:
+			self.log.info(f'Unable to load index: {e}')
+			return False
+
+		with self.indexed:
+			self.seconds = seconds
+			self.offsets = offsets
+			self.indexed_until = float('inf')
+			self.indexed.notify_all()
+		return True
+
+	def _save_index(self):
+		size, mtime = self._get_source_stat()
+		try:
+			with open(self.index_path, 'wb') as f:
+				f.write(ChatFile.INDEX_HEADER.pack(
+					ChatFile.INDEX_MAGIC,
+					ChatFile.INDEX_VERSION,
+					size,
+					mtime,
+					len(self.seconds),
+				))
+				self.seconds.tofile(f)
+				self.offsets.tofile(f)
+		except OSError as e:
+			self.log.warn(f'Unable to save index: {e}')
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import _logging as logging
+from mpv import MPVError
+from utils import format_timestamp_ms
+
+
+class PlaybackClock(object):
+	"""
+	Keeps track of the playback position of an MPV instance.
+
+	This observes the relevant properties, and extrapolates the position from the last known position based on the
+	playback speed and the time that has passed since, so that the position can be retrieved at any time without asking
+	MPV for it.
+	"""
+
+	# The minimum difference (in seconds) between the extrapolated and the reported position for the position to be
+	# considered changed (e.g. by a seek), rather than just being a regular update.
+	JUMP_TRESHOLD = 0.25
+
+	def __init__(self, mpv):
+		self.log = logging.getLogger(__name__, PlaybackClock)
+
+		self.mpv = mpv
+		self.unobservers = []
+
+		# The last known position, and the time.monotonic() at which it was the position. All state is protected by the
+		# condition, which is notified whenever something changes that invalidates earlier extrapolations.
+		self.changed = threading.Condition()
+		self.position = 0.0
+		self.position_time = time.monotonic()
+		self.speed = 1.0
+		self.paused = False
+		self.seeking = False
+		self.stopped = False
+
+	def start(self):
+		""" Start observing the properties needed to keep track of the position. """
+		handlers = {
+			'speed': self._handle_speed,
+			'pause': self._handle_pause,
+			'seeking': self._handle_seeking,
+			'playback-time': self._handle_playback_time,
+		}
+		for prop, handler in handlers.items():
+			self.unobservers.append(self.mpv.observe(prop, handler))
+
+		# Properties that were already observed elsewhere get no initial change event, so get all initial values at once.
+		try:
+			values = self.mpv.get_properties(*handlers)
+		except MPVError as e:
+			self.log.warn(f'Unable to get the initial state, waiting for changes instead: {e}')
+			return
+		for handler, value in zip(handlers.values(), values):
+			handler(value)
+
+	def stop(self):
+		""" Stop observing properties, and wake up everything that is waiting. """
+		with self.changed:
+			self.stopped = True
+			self.changed.notify_all()
+			# This can be called from multiple threads at once, so make sure each unobserver is only called once.
+			unobservers, self.unobservers = self.unobservers, []
+		for unobserver in reversed(unobservers):
+			unobserver()
+
+	def resync(self):
+		""" Ask MPV for the current position, correcting any drift of the extrapolated position. """
+		try:
+			self._handle_playback_time(self.mpv.command('get_property', 'playback-time'))
+		except MPVError as e:
+			self.log.warn(f'Unable to resync the position: {e}')
+
+	def is_running(self):
+		""" Whether the playback position is currently progressing. """
+		with self.changed:
+			return self._is_running()
+
+	def time(self):
+		""" Get the current playback position. """
+		with self.changed:
+			return self._extrapolate(time.monotonic())
+
+	def wait(self, timeout, max_wait = None):
+		"""
+		Wait for the given amount of playback time to pass, but no longer than max_wait seconds of real time (if given).
+
+		This returns early when the clock changes (e.g. due to a seek or a change in speed), so the caller should check
+		the position afterwards. While playback is paused this waits until it resumes (or the clock changes otherwise).
+		"""
+		with self.changed:
+			if self.stopped:
+				return
+			if self._is_running():
+				timeout = timeout / self.speed
+				self.changed.wait(timeout if max_wait is None else min(timeout, max_wait))
+			else:
+				self.changed.wait(max_wait)
+
+	def _is_running(self):
+		return not self.paused and not self.seeking and self.speed > 0
+
+	def _extrapolate(self, now):
+		if not self._is_running():
+			return self.position
+		return self.position + (now - self.position_time) * self.speed
+
+	def _rebase(self):
+		""" Move the reference point to the current time, so that the state can be changed without affecting the past. """
+		now = time.monotonic()
+		self.position = self._extrapolate(now)
+		self.position_time = now
+
+	def _handle_speed(self, speed):
+		with self.changed:
+			self._rebase()
+			self.speed = float(speed or 0)
+			self.log.debug(f'Speed changed to {self.speed}')
+			self.changed.notify_all()
+
+	def _handle_pause(self, paused):
+		with self.changed:
+			self._rebase()
+			self.paused = bool(paused)
+			self.log.debug('Video is paused' if self.paused else 'Video is resumed')
+			self.changed.notify_all()
+
+	def _handle_seeking(self, seeking):
+		with self.changed:
+			self._rebase()
+			self.seeking = bool(seeking)
+			self.changed.notify_all()
+
+	def _handle_playback_time(self, position):
+		if position is None:
+			return
+		with self.changed:
+			now = time.monotonic()
+			expected = self._extrapolate(now)
+			self.position = float(position)
+			self.position_time = now
+			if abs(self.position - expected) >= PlaybackClock.JUMP_TRESHOLD:
+				self.log.debug(f'Position jumped from {format_timestamp_ms(expected)} to {format_timestamp_ms(self.position)}')
+				self.changed.notify_all()
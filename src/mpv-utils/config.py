@@ -192,4 +192,5 @@ class Config(ConfigUpdater):
 				f"Invalid value for property {section}.{key}: '{value}'. "
 				f'Valid options are: {", ".join(options)}'
 			)
+		return value.lower()
 
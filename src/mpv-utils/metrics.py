@@ -0,0 +1,267 @@
+from bisect import bisect_left
+import os
+import os.path
+import socket
+import threading
+import time
+
+from config import Configurable
+import _logging as logging
+
+
+# Bucket boundaries for common kinds of histograms.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 75, 100, 150, 200)
+
+
+class Metric(object):
+	"""
+	Base class for metrics.
+
+	A metric has a value for each combination of label values it is used with. Labels are passed as keyword arguments
+	when recording a value, e.g. counter.inc(event = 'seek').
+	"""
+
+	TYPE = None
+
+	def __init__(self, name, description):
+		self.name = name
+		self.description = description
+		self.lock = threading.Lock()
+		self.values = {}
+
+	def render(self):
+		""" Render the metric in the Prometheus text format. """
+		lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+		with self.lock:
+			values = sorted(self.values.items())
+		for labels, value in values:
+			lines += self._render_value(labels, value)
+		return lines
+
+	def _render_value(self, labels, value):
+		return [f'{self.name}{_format_labels(labels)} {_format_number(value)}']
+
+
+class Counter(Metric):
+	""" A value that only goes up, such as the amount of events received. """
+
+	TYPE = 'counter'
+
+	def inc(self, amount = 1, **labels):
+		key = _make_key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+	""" A value that can go up and down, such as the size of a buffer. """
+
+	TYPE = 'gauge'
+
+	def set(self, value, **labels):
+		key = _make_key(labels)
+		with self.lock:
+			self.values[key] = value
+
+
+class Histogram(Metric):
+	""" The distribution of a value, such as the duration of requests, counted in buckets. """
+
+	TYPE = 'histogram'
+
+	def __init__(self, name, description, buckets):
+		super(Histogram, self).__init__(name, description)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, **labels):
+		key = _make_key(labels)
+		i = bisect_left(self.buckets, value)
+		with self.lock:
+			try:
+				counts, total = self.values[key]
+			except KeyError:
+				counts, total = [0] * (len(self.buckets) + 1), 0
+			counts[i] += 1
+			self.values[key] = (counts, total + value)
+
+	def _render_value(self, labels, value):
+		counts, total = value
+		lines = []
+		cumulative = 0
+		for bound, count in zip(self.buckets + (float('inf'),), counts):
+			cumulative += count
+			bucket_labels = labels + (('le', _format_number(bound)),)
+			lines.append(f'{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+		lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_number(total)}')
+		lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+		return lines
+
+
+class Registry(object):
+	""" A collection of metrics. Metrics are created on first use, and shared by name after that. """
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics = {}
+
+	def counter(self, name, description):
+		return self._get(Counter, name, description)
+
+	def gauge(self, name, description):
+		return self._get(Gauge, name, description)
+
+	def histogram(self, name, description, buckets = LATENCY_BUCKETS):
+		return self._get(Histogram, name, description, buckets)
+
+	def _get(self, cls, name, description, *args):
+		with self.lock:
+			metric = self.metrics.get(name)
+			if metric is None:
+				metric = self.metrics[name] = cls(name, description, *args)
+			elif not isinstance(metric, cls):
+				raise ValueError(f'Metric {name} already exists as a {metric.TYPE}')
+			return metric
+
+	def render(self):
+		""" Render all metrics in the Prometheus text format. """
+		with self.lock:
+			metrics = sorted(self.metrics.values(), key = lambda metric: metric.name)
+		lines = []
+		for metric in metrics:
+			lines += metric.render()
+		return '\n'.join(lines) + '\n'
+
+
+# The registry that all modules record into.
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def _make_key(labels):
+	""" The key to store the value for the given labels under. Values are converted to strings so that keys sort. """
+	return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	values = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+	return f'{{{values}}}'
+
+
+def _escape(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value):
+	if value == float('inf'):
+		return '+Inf'
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return str(value)
+
+
+class MetricsExporter(threading.Thread, Configurable):
+	"""
+	Exports the metrics in the Prometheus text format.
+
+	Depending on the configuration, the metrics are written to a file at a fixed interval (e.g. for the textfile
+	collector of the Prometheus node exporter), and/or served on a Unix socket, where each connection receives the
+	current metrics and is then closed (e.g. `socat - UNIX-CONNECT:<path>`).
+	"""
+
+	# The maximum time (in seconds) to wait for a connection before checking whether a stop was requested.
+	ACCEPT_TIMEOUT = 1
+
+	# The minimum time (in seconds) to wait for a connection. A timeout of zero would make the socket non-blocking.
+	MIN_ACCEPT_TIMEOUT = 0.01
+
+	def __init__(self, registry = REGISTRY):
+		super(MetricsExporter, self).__init__()
+
+		self.log = logging.getLogger(__name__, MetricsExporter)
+
+		self.registry = registry
+		self.stop_requested = threading.Event()
+		self.server = None
+
+	@classmethod
+	def configure(cls, config):
+		cls.file_path = config.get_str('core', 'metrics_file')
+		cls.interval = config.get_float('core', 'metrics_interval')
+		cls.socket_path = config.get_str('core', 'metrics_socket')
+
+	@classmethod
+	def open(cls):
+		""" Get an exporter if exporting is enabled, or None otherwise. """
+		if not cls.file_path and not cls.socket_path:
+			return None
+		return cls()
+
+	def stop(self):
+		self.stop_requested.set()
+
+	def run(self):
+		try:
+			if self.socket_path:
+				self._listen()
+			self._run()
+		except Exception as e:
+			self.log.exception(e)
+		finally:
+			if self.file_path:
+				self._write_file()
+			if self.server:
+				self.server.close()
+				os.unlink(self.socket_path)
+
+	def _run(self):
+		next_write = time.monotonic()
+		while not self.stop_requested.is_set():
+			now = time.monotonic()
+			if self.file_path and now >= next_write:
+				self._write_file()
+				next_write = max(next_write + self.interval, now)
+			timeout = MetricsExporter.ACCEPT_TIMEOUT
+			if self.file_path:
+				timeout = min(timeout, next_write - now)
+			if self.server:
+				self._serve(max(timeout, MetricsExporter.MIN_ACCEPT_TIMEOUT))
+			else:
+				self.stop_requested.wait(timeout)
+
+	def _write_file(self):
+		""" Write the metrics to the file, replacing it at once so that it's never read while partially written. """
+		temp_path = f'{self.file_path}.tmp'
+		try:
+			with open(temp_path, 'w') as f:
+				f.write(self.registry.render())
+			os.replace(temp_path, self.file_path)
+		except OSError as e:
+			self.log.warn(f'Unable to write metrics to {self.file_path}: {e}')
+
+	def _listen(self):
+		""" Start listening on the Unix socket, replacing a socket left behind by an earlier run. """
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(self.socket_path)
+		self.server.listen()
+
+	def _serve(self, timeout):
+		""" Wait up to timeout seconds for a connection, and send the metrics to it. """
+		self.server.settimeout(timeout)
+		try:
+			client, _ = self.server.accept()
+		except (socket.timeout, BlockingIOError):
+			return
+		try:
+			with client:
+				client.settimeout(MetricsExporter.ACCEPT_TIMEOUT)
+				client.sendall(self.registry.render().encode('utf-8'))
+		except OSError as e:
+			self.log.debug(f'Unable to send metrics: {e}')
@@ -1,54 +1,138 @@
 from collections import defaultdict
+from concurrent.futures import Future, TimeoutError
+from functools import lru_cache
 import json
+import queue
+import selectors
 import socket
 import sys
 import threading
+import time
 
 from config import Configurable
 import _logging as logging
-
-
-class EventWithMessage(threading.Event):
-	""" A subclass of threading.Event that can pass more data along than just set/not set. """
-	def __init__(self, *args, **kwargs):
-		super(EventWithMessage, self).__init__(*args, **kwargs)
-		self.data = None
-
-	def set(self, data):
-		if self.is_set():
-			raise Exception('Cannot set twice')
-		self.data = data
-		super(EventWithMessage, self).set()
-
-	def clear(self):
-		super(EventWithMessage, self).clear()
-		self.data = None
-
-	def wait(self, *args, **kwargs):
-		super(EventWithMessage, self).wait(*args, **kwargs)
-		return self.data
+import metrics
+
+try:
+	import orjson
+
+	json_dumps = orjson.dumps
+	json_loads = orjson.loads
+except ImportError:
+	def json_dumps(data):
+		return json.dumps(data, separators = (',', ':')).encode('utf-8')
+	json_loads = json.loads
+
+
+COMMAND_DURATION = metrics.histogram(
+	'mpv_command_duration_seconds',
+	'Time between sending a command to MPV and receiving the response to it.',
+)
+COMMAND_ERRORS = metrics.counter('mpv_command_errors_total', 'Commands that MPV responded to with an error.')
+EVENTS = metrics.counter('mpv_events_total', 'Events received from MPV.')
+
+
+def encode_command(command, request_id):
+	""" Encode a command (a tuple of the command name and its arguments) as a line of IPC data. """
+	try:
+		# The types are part of the key so that equal values of different types (e.g. True and 1) are kept apart.
+		prefix = _encode_command_prefix(command, tuple(type(arg) for arg in command))
+	except TypeError:
+		# Not hashable, so not cacheable.
+		prefix = _encode_command_prefix.__wrapped__(command, None)
+	return prefix + str(request_id).encode('ascii') + b'}\n'
+
+
+@lru_cache(maxsize = 256)
+def _encode_command_prefix(command, types):
+	"""
+	Encode everything that comes before the request ID for a command.
+
+	This is the bulk of the work of encoding a command, and it is the same every time a command is sent, so this is
+	cached. The types argument is only used as part of the cache key.
+	"""
+	return b'{"command":' + json_dumps(list(command)) + b',"request_id":'
+
+
+class CommandFuture(Future):
+	""" A Future that resolves to the response of an MPV IPC command. """
+	def __init__(self, request_id):
+		super(CommandFuture, self).__init__()
+		self.request_id = request_id
+
+
+class FrameReader(object):
+	"""
+	Incrementally splits the data received from a socket into newline-terminated frames.
+
+	Data is received directly into a reusable buffer, and each byte is only scanned for a newline once, so the cost of
+	processing a burst of messages is linear in the amount of data, regardless of how it is split across reads.
+	"""
+
+	def __init__(self, read_size):
+		self.read_size = read_size
+		self.buffer = bytearray(read_size * 2)
+		# The buffer contains unprocessed data between start and end, of which everything before scan_offset has already
+		# been checked for newlines.
+		self.start = 0
+		self.end = 0
+		self.scan_offset = 0
+
+	def receive(self, sock):
+		""" Receive data from the socket into the buffer. Returns the amount of bytes received. """
+		self._make_room()
+		with memoryview(self.buffer) as view:
+			received = sock.recv_into(view[self.end:self.end + self.read_size])
+		self.end += received
+		return received
+
+	def frames(self):
+		""" Yield all complete frames that have been received, without the trailing newline. """
+		while True:
+			index = self.buffer.find(b'\n', self.scan_offset, self.end)
+			if index == -1:
+				self.scan_offset = self.end
+				return
+			frame = self.buffer[self.start:index]
+			self.start = self.scan_offset = index + 1
+			yield frame
+
+	def _make_room(self):
+		""" Make sure there is room for at least read_size more bytes after the end of the buffer. """
+		if self.start == self.end:
+			self.start = self.end = self.scan_offset = 0
+		if len(self.buffer) - self.end >= self.read_size:
+			return
+
+		# Move the incomplete frame to the start of the buffer, and grow the buffer if this is not enough.
+		pending = self.end - self.start
+		self.buffer[:pending] = self.buffer[self.start:self.end]
+		self.scan_offset -= self.start
+		self.start = 0
+		self.end = pending
+		if len(self.buffer) - self.end < self.read_size:
+			self.buffer.extend(bytes(self.end + self.read_size - len(self.buffer)))
 
 
 class MPVError(Exception):
 	""" An error that was received in response to an MPV IPC call. """
 
 
-class MPV(threading.Thread, Configurable):
-	""" Integration with MPV over the IPC socket. """
-
-	def __init__(self, reconnect = True):
-		super(MPV, self).__init__()
+class BaseMPV(Configurable):
+	"""
+	The transport-independent part of the MPV IPC protocol.
 
-		self.log = logging.getLogger(__name__, MPV)
+	This keeps track of request IDs, pending requests, event handlers and property observers, so that the threaded and
+	the asyncio clients behave the same. Subclasses are responsible for the actual connection.
+	"""
 
-		self.reconnect = reconnect
-		self.stop_requested = threading.Event()
+	# The amount of seconds to wait for a response to a command before giving up.
+	COMMAND_TIMEOUT = 5
 
-		# Data to be sent to the client.
-		self.send_buffer = b''
-		self.send_lock = threading.Lock()
+	def __init__(self):
+		super(BaseMPV, self).__init__()
 
-		# Used to store listeners and responses.
+		# Used to store the futures of commands that are awaiting a response.
 		self.request_id = 1
 		self.listeners = {}
 		self.listener_lock = threading.Lock()
@@ -69,133 +153,479 @@ class MPV(threading.Thread, Configurable):
 	@classmethod
 	def configure(cls, config):
 		cls.socket_path = config.get_str('core', 'socket_path')
+		cls.socket_read_size = config.get_int('core', 'socket_read_size')
+
+	def _create_requests(self, commands, create_future):
+		"""
+		Register a request for each of the given commands.
+
+		Returns the futures created by create_future (which is called with the request ID) and the data to send.
+		"""
+		futures = []
+		now = time.monotonic()
+		with self.listener_lock:
+			for command in commands:
+				future = create_future(self.request_id)
+				future.command_name = command[0]
+				future.sent_time = now
+				self.request_id += 1
+				self.listeners[future.request_id] = future
+				futures.append(future)
+		data = b''.join(encode_command(command, future.request_id) for command, future in zip(commands, futures))
+		return futures, data
+
+	def _forget_request(self, request_id):
+		""" Stop waiting for the response to a request. """
+		with self.listener_lock:
+			self.listeners.pop(request_id, None)
+
+	def _process_message(self, message):
+		if 'request_id' in message:
+			request_id = message['request_id']
+			with self.listener_lock:
+				listener = self.listeners.pop(request_id, None)
+			if not listener:
+				self.log.warn(f'Received response for request {request_id}, but there is no listener: {message}')
+				return
+			COMMAND_DURATION.observe(time.monotonic() - listener.sent_time, command = listener.command_name)
+			if message['error'] != 'success':
+				COMMAND_ERRORS.inc(command = listener.command_name)
+				self.log.error(f'Received error in response to request {request_id}: {message["error"]}')
+				self._resolve_request(listener, error = MPVError(message['error']))
+			else:
+				self.log.debug(f'Received response for request {request_id}: {message}')
+				self._resolve_request(listener, result = message.get('data'))
+		elif 'event' in message:
+			self.log.debug(f'Received event {message["event"]}: {message}')
+			EVENTS.inc(event = message['event'])
+			self._dispatch_event(message)
+		else:
+			self.log.warn(f'Received unknown message: {message}')
+
+	def _dispatch_event(self, message):
+		""" Invoke the handlers for an event. """
+		with self.handler_lock:
+			handlers = list(self.handlers[message['event']])
+		for handler in handlers:
+			handler(message)
+
+	def _resolve_request(self, future, result = None, error = None):
+		""" Pass the response to a request on to its future. """
+		raise NotImplementedError()
+
+	def on(self, event, handler):
+		""" Listen to an MPV event. """
+		self.log.info(f'Adding handler {handler} to event {event}')
+		with self.handler_lock:
+			self.handlers[event].append(handler)
+		return lambda: self.off(event, handler)
+
+	def off(self, event, handler):
+		""" Stop listening to an MPV event. """
+		self.log.info(f'Removing handler {handler} from event {event}')
+		with self.handler_lock:
+			self.handlers[event].remove(handler)
+
+	def _add_observer(self, prop, handler):
+		"""
+		Register an observer for a property.
+
+		Returns the observer ID to start observing the property with if this is the first observer, or None otherwise.
+		"""
+		self.log.info(f'Adding observer {handler} to property {prop}')
+		with self.observer_lock:
+			self.observers[prop].append(handler)
+			if prop in self.observer_ids:
+				return None
+			observer_id = self.observer_id
+			self.observer_id += 1
+			self.observer_ids[prop] = observer_id
+			return observer_id
+
+	def _remove_observer(self, prop, handler):
+		"""
+		Unregister an observer for a property.
+
+		Returns the observer ID to stop observing the property with if this was the last observer, or None otherwise.
+		"""
+		self.log.info(f'Removing observer {handler} from property {prop}')
+		with self.observer_lock:
+			self.observers[prop].remove(handler)
+			if self.observers[prop]:
+				return None
+			return self.observer_ids.pop(prop)
+
+	def _observe_handler(self, message):
+		""" Handles all property-change events, and triggers observers from it. """
+		with self.observer_lock:
+			data = message.get('data')
+			handlers = list(self.observers[message['name']])
+		for handler in handlers:
+			handler(data)
+
+
+class MPV(BaseMPV, threading.Thread):
+	"""
+	Integration with MPV over the IPC socket.
+
+	Event handlers and observers are invoked on a separate dispatch thread, in the order the events were received. This
+	means they are free to send commands to MPV and wait for the response, as the IPC thread is never blocked by them.
+
+	When reconnecting is enabled, a lost connection is retried with exponential backoff. Commands that are waiting for a
+	response fail right away when the connection is lost, and all active observers are restored after reconnecting.
+	"""
+
+	# The minimum and maximum amount of seconds to wait between attempts to (re)connect.
+	RECONNECT_DELAY_MIN = 0.1
+	RECONNECT_DELAY_MAX = 10
+
+	def __init__(self, reconnect = True):
+		super(MPV, self).__init__()
+
+		self.log = logging.getLogger(__name__, MPV)
+
+		self.reconnect = reconnect
+		self.stop_requested = threading.Event()
+
+		# Data to be sent to the client.
+		self.send_buffer = b''
+		self.send_lock = threading.Lock()
+
+		# Used to wake up the IPC thread when there is data to send or when a stop is requested, so that it can block
+		# until something actually happens instead of polling.
+		self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+		self.wakeup_receiver.setblocking(False)
+		self.wakeup_sender.setblocking(False)
+
+		# Work for the dispatch thread, as (function, argument) pairs. Mostly received events that still need to be passed
+		# to the handlers.
+		self.dispatch_queue = queue.Queue()
+		self.dispatcher = threading.Thread(target = self._dispatch_events, daemon = True)
+
+		# Local copies of properties, as a mapping of property name to a (value, time.monotonic() of update) tuple, and the
+		# observers that keep these up to date.
+		self.mirror_values = {}
+		self.mirror_handlers = {}
+		self.mirror_lock = threading.Lock()
+
+		# The observers that were active when the connection was lost, which need to be restored when reconnecting.
+		self.replay_observer_ids = {}
+
+		# Statistics about the connection. Times are time.monotonic() values.
+		self.connect_count = 0
+		self.failed_connect_count = 0
+		self.last_connect_time = None
+		self.last_disconnect_time = None
+		self.total_downtime = 0.0
 
 	def stop(self):
 		self.stop_requested.set()
+		self._wakeup()
 
 	def run(self):
+		self.dispatcher.start()
 		try:
 			self._run()
 		except Exception as e:
 			self.log.exception(e)
+		finally:
+			self.wakeup_receiver.close()
+			self.wakeup_sender.close()
+			self.dispatch_queue.put(None)
 
 	def _run(self):
-		self._connect_and_process()
-		if self.reconnect:
-			while not self.stop_requested.is_set():
-				self._connect_and_process()
-
-	def _connect_and_process(self):
-		with socket.socket(socket.AF_UNIX) as client:
-			client.settimeout(1)
+		delay = MPV.RECONNECT_DELAY_MIN
+		while not self.stop_requested.is_set():
+			try:
+				client = self._connect()
+			except OSError as e:
+				self.failed_connect_count += 1
+				if not self.reconnect:
+					raise
+				self.log.warn(f'Unable to connect to MPV ({e}), retrying in {delay:.1f} seconds')
+				self.stop_requested.wait(delay)
+				delay = min(delay * 2, MPV.RECONNECT_DELAY_MAX)
+				continue
+
+			delay = MPV.RECONNECT_DELAY_MIN
+			try:
+				with client:
+					self._process(client)
+			except OSError as e:
+				self.log.warn(f'Connection to MPV lost: {e}')
+			finally:
+				self._handle_disconnect()
+
+			if not self.reconnect:
+				return
+			self.stop_requested.wait(delay)
+
+	def _connect(self):
+		""" Connect to MPV, and restore the state from the previous connection (if any). """
+		client = socket.socket(socket.AF_UNIX)
+		try:
 			client.connect(self.socket_path)
+		except OSError:
+			client.close()
+			raise
+
+		self.last_connect_time = time.monotonic()
+		self.connect_count += 1
+		if self.last_disconnect_time is not None:
+			downtime = self.last_connect_time - self.last_disconnect_time
+			self.total_downtime += downtime
+			self.log.info(
+				f'Reconnected to MPV after {downtime:.1f} seconds '
+				f'(reconnect {self.connect_count - 1}, {self.failed_connect_count} failed attempts in total)'
+			)
+
+		self._replay_observers()
+		return client
+
+	def _replay_observers(self):
+		"""
+		Restore the observers that were active when the previous connection was lost.
+
+		Observers that have been added since are skipped, as these have already queued their own observe command.
+		"""
+		with self.observer_lock:
+			commands = [
+				('observe_property', observer_id, prop)
+				for prop, observer_id in self.replay_observer_ids.items()
+				if self.observer_ids.get(prop) == observer_id
+			]
+			self.replay_observer_ids = {}
+		if not commands:
+			return
+
+		self.log.info(f'Restoring {len(commands)} observers')
+		futures, data = self._create_requests(commands, CommandFuture)
+		with self.send_lock:
+			self.send_buffer = data + self.send_buffer
+		for future in futures:
+			future.add_done_callback(self._check_replay_result)
+
+	def _check_replay_result(self, future):
+		if future.exception():
+			self.log.error(f'Unable to restore observer with request {future.request_id}: {future.exception()}')
+
+	def _handle_disconnect(self):
+		""" Clean up after the connection has been lost. """
+		self.last_disconnect_time = time.monotonic()
+		with self.observer_lock:
+			self.replay_observer_ids = dict(self.observer_ids)
 
-			buffer = ''
+		# The mirrored values might be stale from now on. Clear them right away so that they are no longer used, and
+		# again once any updates that are still queued have been dispatched.
+		self._clear_mirror(None)
+		self.dispatch_queue.put((self._clear_mirror, None))
+
+		# Anything that was still waiting to be sent or waiting for a response was meant for the old connection.
+		with self.send_lock:
+			self.send_buffer = b''
+		with self.listener_lock:
+			listeners = list(self.listeners.values())
+			self.listeners.clear()
+		if listeners:
+			self.log.warn(f'Failing {len(listeners)} requests that were waiting for a response')
+		for listener in listeners:
+			self._resolve_request(listener, error = MPVError('Connection lost'))
+
+	def _process(self, client):
+		""" Send and receive data over the connection, until it is closed or a stop is requested. """
+		with selectors.DefaultSelector() as selector:
+			client.setblocking(False)
+			selector.register(client, selectors.EVENT_READ)
+			selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+
+			reader = FrameReader(self.socket_read_size)
 			while not self.stop_requested.is_set():
-				if self.send_buffer:
-					with self.send_lock:
-						client.sendall(self.send_buffer)
-						self.send_buffer = b''
-				try:
-					received_bytes = client.recv(1024)
-				except socket.timeout:
-					continue
-				buffer += received_bytes.decode('utf-8')
-				while '\n' in buffer:
-					message, buffer = buffer.split('\n', 1)
-					message = json.loads(message)
-					if 'request_id' in message:
-						request_id = message['request_id']
-						with self.listener_lock:
-							listener = self.listeners.get(request_id)
-							if listener:
-								self.log.debug(f'Received response for request {request_id}: {message}')
-								listener.set(message)
-							else:
-								self.log.warn(f'Received response for request {request_id}, but there is no listener: {message}')
-					elif 'event' in message:
-						event = message['event']
-						self.log.debug(f'Received event {event}: {message}')
-						with self.handler_lock:
-							for handler in self.handlers[event]:
-								handler(message)
-					else:
-						self.log.warn(f'Received unknown message: {message}')
+				# Only wait for the socket to become writable if there is something to write, as it is almost always
+				# writable and we'd end up spinning otherwise.
+				with self.send_lock:
+					client_events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.send_buffer else 0)
+				selector.modify(client, client_events)
+
+				for key, mask in selector.select():
+					if key.fileobj is self.wakeup_receiver:
+						self._drain_wakeup()
+						continue
+
+					if mask & selectors.EVENT_WRITE:
+						with self.send_lock:
+							try:
+								sent = client.send(self.send_buffer)
+							except BlockingIOError:
+								sent = 0
+							self.send_buffer = self.send_buffer[sent:]
+
+					if mask & selectors.EVENT_READ:
+						try:
+							received = reader.receive(client)
+						except BlockingIOError:
+							continue
+						if not received:
+							self.log.warn('Connection closed by MPV')
+							return
+						for frame in reader.frames():
+							self._process_message(json_loads(frame))
+
+	def _dispatch_event(self, message):
+		self.dispatch_queue.put((super(MPV, self)._dispatch_event, message))
+
+	def _dispatch_events(self):
+		""" Process the dispatch queue, until the sentinel (None) is received. """
+		while True:
+			item = self.dispatch_queue.get()
+			if item is None:
+				return
+			function, argument = item
+			try:
+				function(argument)
+			except Exception as e:
+				self.log.exception(e)
+
+	def _wakeup(self):
+		""" Wake up the IPC thread if it is waiting for activity. """
+		try:
+			self.wakeup_sender.send(b'\0')
+		except OSError:
+			# Either there's already a wakeup pending, or the thread has already shut down. Either way, nothing to do.
+			pass
+
+	def _drain_wakeup(self):
+		""" Clear all pending wakeups. """
+		try:
+			while self.wakeup_receiver.recv(1024):
+				pass
+		except BlockingIOError:
+			pass
 
 	def _send(self, data):
 		self.log.debug(f'Adding message to send buffer: {data}')
 		with self.send_lock:
-			self.send_buffer += (data + '\n').encode('utf-8')
+			self.send_buffer += data
+		self._wakeup()
 
 	def command(self, command, *args):
 		""" Send a command to MPV, and wait for a response. """
-		event = EventWithMessage()
-		with self.listener_lock:
-			request_id = self.request_id
-			self.request_id += 1
-			self.listeners[request_id] = event
+		return self.wait(self.command_async(command, *args))
 
-		try:
-			command_data = {
-				'command': [command, *args],
-				'request_id': request_id,
-			}
-			self._send(json.dumps(command_data))
-
-			response = event.wait(5)
-			if response is None:
-				self.log.error(f'Timeout while waiting for a response to request {request_id}')
-				raise MPVError('No response received')
-			elif response['error'] != 'success':
-				self.log.error(f'Error while waiting for a response to request {request_id}: {response["error"]}')
-				raise MPVError(response['error'])
-			return response.get('data')
-		finally:
-			with self.listener_lock:
-				del self.listeners[request_id]
+	def command_async(self, command, *args):
+		""" Send a command to MPV, and return a CommandFuture for the response. """
+		return self.command_batch((command, *args))[0]
 
-	def on(self, event, handler):
-		""" Listen to an MPV event. """
-		self.log.info(f'Adding handler {handler} to event {event}')
-		with self.handler_lock:
-			self.handlers[event].append(handler)
-		return lambda: self.off(event, handler)
-	
-	def off(self, event, handler):
-		""" Stop listening to an MPV event. """
-		self.log.info(f'Removing handler {handler} from event {event}')
-		with self.handler_lock:
-			self.handlers[event].remove(handler)
+	def command_batch(self, *commands):
+		"""
+		Send multiple commands to MPV in a single write, and return a list of CommandFutures for the responses.
+
+		Each command is a tuple of the command name followed by its arguments. As the commands are sent together, the
+		responses will generally arrive together as well, so this takes a single round trip rather than one per command.
+
+		Note that callbacks added to the futures are invoked on the IPC thread, so they should not block.
+		"""
+		futures, data = self._create_requests(commands, CommandFuture)
+		self._send(data)
+		return futures
+
+	def wait(self, future, timeout = None):
+		""" Wait for the response to a command sent with command_async or command_batch. """
+		try:
+			return future.result(timeout or MPV.COMMAND_TIMEOUT)
+		except TimeoutError:
+			self.log.error(f'Timeout while waiting for a response to request {future.request_id}')
+			self._forget_request(future.request_id)
+			raise MPVError('No response received')
+
+	def _resolve_request(self, future, result = None, error = None):
+		if not future.set_running_or_notify_cancel():
+			self.log.debug(f'Dropping response for cancelled request {future.request_id}')
+		elif error:
+			future.set_exception(error)
+		else:
+			future.set_result(result)
 
 	def observe(self, prop, handler, request_initial = False):
 		""" Listen to changes to an MPV property. """
-		self.log.info(f'Adding observer {handler} to property {prop}')
-		with self.observer_lock:
-			self.observers[prop].append(handler)
-			if prop not in self.observer_ids:
-				# First observer of this property, so start listening
-				observer_id = self.observer_id
-				self.observer_id += 1
-				self.observer_ids[prop] = observer_id
-				self.command('observe_property', observer_id, prop)
+		observer_id = self._add_observer(prop, handler)
+		if observer_id is not None:
+			# First observer of this property, so start listening
+			self.command('observe_property', observer_id, prop)
 		if request_initial:
 			handler(self.command('get_property', prop))
 		return lambda: self.unobserve(prop, handler)
 
 	def unobserve(self, prop, handler):
 		""" Stop listening to changes to an MPV property. """
-		self.log.info(f'Removing observer {handler} from property {prop}')
-		with self.observer_lock:
-			self.observers[prop].remove(handler)
-			if not self.observers[prop]:
-				# Last observer of this property, so stop listening
-				observer_id = self.observer_ids[prop]
-				del self.observer_ids[prop]
-				self.command('unobserve-property', observer_id)
-
-	def _observe_handler(self, message):
-		""" Handles all property-change events, and triggers observers from it. """
-		with self.observer_lock:
-			data = message['data']
-			for handler in self.observers[message['name']]:
-				handler(data)
+		observer_id = self._remove_observer(prop, handler)
+		if observer_id is not None:
+			# Last observer of this property, so stop listening
+			self.command('unobserve-property', observer_id)
+
+	def mirror(self, *props):
+		"""
+		Keep a local copy of the given properties.
+
+		The copies are kept up to date by observing the properties, and are used by get_property and get_properties
+		instead of asking MPV. This is useful for properties that are requested often.
+		"""
+		for prop in props:
+			with self.mirror_lock:
+				if prop in self.mirror_handlers:
+					continue
+				handler = self.mirror_handlers[prop] = lambda value, prop = prop: self._update_mirror(prop, value)
+			self.log.info(f'Mirroring property {prop}')
+			self.observe(prop, handler)
+
+	def unmirror(self, *props):
+		""" Stop keeping a local copy of the given properties. """
+		for prop in props:
+			with self.mirror_lock:
+				handler = self.mirror_handlers.pop(prop)
+				self.mirror_values.pop(prop, None)
+			self.log.info(f'No longer mirroring property {prop}')
+			self.unobserve(prop, handler)
+
+	def get_mirrored(self, prop):
+		"""
+		Get the local copy of a property.
+
+		Returns a (value, time.monotonic() of last update) tuple, or None if there is no (up to date) copy available.
+		"""
+		with self.mirror_lock:
+			return self.mirror_values.get(prop)
+
+	def get_property(self, prop):
+		""" Get the value of a property, from the local copy if available, and from MPV otherwise. """
+		return self.get_properties(prop)[0]
+
+	def get_properties(self, *props):
+		"""
+		Get the values of multiple properties.
+
+		The values of mirrored properties are taken from the local copies, and the rest is requested in a single batch.
+		"""
+		values = {}
+		with self.mirror_lock:
+			for prop in props:
+				if prop in self.mirror_values:
+					values[prop] = self.mirror_values[prop][0]
+		missing = [prop for prop in props if prop not in values]
+		futures = self.command_batch(*[('get_property', prop) for prop in missing]) if missing else []
+		for prop, future in zip(missing, futures):
+			values[prop] = self.wait(future)
+		return [values[prop] for prop in props]
+
+	def _update_mirror(self, prop, value):
+		with self.mirror_lock:
+			if prop not in self.mirror_handlers:
+				return
+			if value is None:
+				# The property is unavailable, so requesting it should fail, which only MPV can do.
+				self.mirror_values.pop(prop, None)
+			else:
+				self.mirror_values[prop] = (value, time.monotonic())
+
+	def _clear_mirror(self, _):
+		with self.mirror_lock:
+			self.mirror_values.clear()
@@ -0,0 +1,121 @@
+from config import Configurable
+import _logging as logging
+import metrics
+from utils import format_timestamp
+
+
+DROPPED_MESSAGES = metrics.counter('printer_dropped_messages_total', 'Messages left out because chat was falling behind.')
+OVERLOAD_ACTIVE = metrics.gauge('printer_overload_active', 'Whether the overload policy is limiting the printed messages.')
+
+
+class OverloadPolicy(Configurable):
+	"""
+	Decides which messages to print when chat is busier than can be shown.
+
+	The render lag (how long after their timestamp messages get printed) is tracked as a moving average. Once it gets too
+	high the policy switches on, and batches of messages are reduced to at most max_rate messages per second of playback.
+	It switches off again once the lag has recovered. The configured mode determines how batches are reduced:
+
+	- none: print everything.
+	- rate: print the first messages, and drop the rest.
+	- sample: print an evenly spread sample of the messages.
+	- collapse: print the first messages, and replace the rest with a single line saying how many were left out.
+
+	If priority is enabled, messages of users with badges are preferred over other messages.
+	"""
+
+	MODES = ('none', 'rate', 'sample', 'collapse')
+
+	# The weight of a new measurement in the moving average of the lag.
+	SMOOTHING = 0.2
+
+	# The lag (in seconds) above which the policy switches on, and below which it switches off again.
+	LAG_ON = 1.0
+	LAG_OFF = 0.25
+
+	def __init__(self):
+		self.log = logging.getLogger(__name__, OverloadPolicy)
+
+		self.lag = 0.0
+		self.active = False
+		# The amount of messages that may still be printed, which grows with max_rate per second of playback up to a
+		# maximum of max_rate, and the timestamp at which it was last updated.
+		self.allowance = 0.0
+		self.allowance_timestamp = None
+		self.dropped = 0
+
+	@classmethod
+	def configure(cls, config):
+		cls.mode = config.get_enum('twitch', 'overload_policy', OverloadPolicy.MODES)
+		cls.max_rate = config.get_float('twitch', 'overload_max_rate')
+		cls.priority = config.get_bool('twitch', 'overload_priority')
+
+	def reset(self):
+		""" Forget the lag and allowance, e.g. after a seek. """
+		self.lag = 0.0
+		self.active = False
+		self.allowance_timestamp = None
+		OVERLOAD_ACTIVE.set(0)
+
+	def record_lag(self, lag):
+		""" Record the lag of a printed batch, switching the policy on or off as needed. """
+		self.lag += (max(lag, 0) - self.lag) * OverloadPolicy.SMOOTHING
+		if not self.active and self.lag > OverloadPolicy.LAG_ON and self.mode != 'none':
+			self.log.info(f'Chat is lagging behind by {self.lag:.2f}s, limiting the amount of messages shown')
+			self.active = True
+			OVERLOAD_ACTIVE.set(1)
+		elif self.active and self.lag < OverloadPolicy.LAG_OFF:
+			self.log.info('Chat has caught up, no longer limiting the amount of messages shown')
+			self.active = False
+			OVERLOAD_ACTIVE.set(0)
+
+	def apply(self, timestamp, messages):
+		""" Get the lines to print for a batch of messages at the given timestamp. """
+		self._update_allowance(timestamp)
+		if not self.active or len(messages) <= self.allowance:
+			self.allowance = max(0, self.allowance - len(messages))
+			return [message.line for message in messages]
+
+		allowed = max(1, int(self.allowance))
+		if self.mode == 'collapse':
+			allowed = max(1, allowed - 1)
+		self.allowance = max(0, self.allowance - allowed)
+
+		kept = self._select(messages, allowed)
+		dropped = len(messages) - len(kept)
+		self.dropped += dropped
+		DROPPED_MESSAGES.inc(dropped, policy = self.mode)
+		lines = [message.line for message in kept]
+		if self.mode == 'collapse' and dropped:
+			lines.append(f'{format_timestamp(timestamp)} +{dropped} messages')
+		return lines
+
+	def _update_allowance(self, timestamp):
+		if self.allowance_timestamp is None or timestamp < self.allowance_timestamp:
+			self.allowance = self.max_rate
+		else:
+			self.allowance += (timestamp - self.allowance_timestamp) * self.max_rate
+			self.allowance = min(self.allowance, self.max_rate)
+		self.allowance_timestamp = timestamp
+
+	def _select(self, messages, count):
+		""" Select the given amount of messages to keep, keeping them in order. """
+		if self.priority:
+			preferred = [i for i, message in enumerate(messages) if message.badges]
+			others = [i for i, message in enumerate(messages) if not message.badges]
+		else:
+			preferred, others = [], list(range(len(messages)))
+		chosen = self._pick(preferred, count)
+		chosen += self._pick(others, count - len(chosen))
+		return [messages[i] for i in sorted(chosen)]
+
+	def _pick(self, indices, count):
+		""" Pick at most the given amount of indices, according to the mode. """
+		if count <= 0:
+			return []
+		if count >= len(indices):
+			return indices
+		if self.mode == 'sample':
+			step = len(indices) / count
+			return [indices[int(i * step)] for i in range(count)]
+		return indices[:count]
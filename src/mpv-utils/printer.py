@@ -1,28 +1,55 @@
+from collections import deque
+import heapq
+import itertools
+import math
+import sys
 import threading
 import time
 
+from clock import PlaybackClock
 import _logging as logging
+import metrics
+from overload import OverloadPolicy
 from utils import format_timestamp, format_timestamp_ms
 
 
+RENDER_LAG = metrics.histogram(
+	'printer_render_lag_seconds',
+	'Time between the timestamp of a batch of messages and the moment it is printed.',
+	metrics.LAG_BUCKETS,
+)
+WRITE_DURATION = metrics.histogram('printer_write_seconds', 'Time taken to write a frame of output to the terminal.')
+PRINTED_MESSAGES = metrics.counter('printer_messages_total', 'Messages that were due to be printed.')
+
+
 class TwitchChatPrinter(threading.Thread):
 	"""
 	Output relevant Twitch chat messages for an MPV instance.
 
-	This keep tracks of the playback position of an MPV instance, and outputs the chat messages provided by TwitchChat
-	with the corresponding timestamps.
+	This keep tracks of the playback position of an MPV instance using a PlaybackClock, and outputs the chat messages
+	provided by TwitchChat with the corresponding timestamps.
 	"""
 
 	# Messages that have less than this amount of time between them are considered to happen at the same time.
 	MIN_RESOLUTION = 0.05
 
-	# The amount of seconds between syncing the position with MPV.
-	MPV_SYNC_INTERVAL = 5
-
 	# The maximum amount of time to correct without skipping messages when out of sync. When we're lagging behind more
 	# than this, we'll drop a bunch of messages.
 	MAX_CORRECTION_WITHOUT_JUMP = 10
 
+	# When writing the output takes longer than this, the terminal is considered to be lagging behind. Output is then
+	# collected for a while (up to MAX_COALESCE seconds, depending on how slow the write was) before it is written.
+	LAGGING_WRITE_DURATION = 0.05
+	MAX_COALESCE = 1
+
+	# The interval (in seconds of playback) at which the clock is resynchronized with MPV.
+	RESYNC_INTERVAL = 10
+
+	# The kinds of events in the schedule.
+	EVENT_BATCH = 'batch'
+	EVENT_CLOCK = 'clock'
+	EVENT_RESYNC = 'resync'
+
 	def __init__(self, mpv, twitch):
 		super(TwitchChatPrinter, self).__init__()
 
@@ -30,151 +57,186 @@ class TwitchChatPrinter(threading.Thread):
 
 		self.mpv = mpv
 		self.twitch = twitch
+		self.clock = PlaybackClock(mpv)
+		self.overload = OverloadPolicy()
 		self.stop_requested = threading.Event()
 
-		self.buffer = []
+		self.buffer = deque()
+		self.cursor = iter(())
+		self.next_messages = []
 		self.current_timestamp = 0.0
-		self.next_request_timestamp = 0
-		self.last_sync = float('-inf')
 
-		self.is_paused = None
-		self.pause_cond = threading.Condition()
+		# The upcoming events, as a heap of (timestamp, sequence number, event) tuples.
+		self.schedule = []
+		self.schedule_counter = itertools.count()
+
+		# The output that has not been written yet, the clock line as it is currently shown (or None if it isn't), and the
+		# time.monotonic() until which output is being collected.
+		self.frame = []
+		self.clock_line = None
+		self.coalesce_until = 0
 
 	def stop(self):
 		self.stop_requested.set()
-		with self.pause_cond:
-			self.is_paused = False
-			self.pause_cond.notify_all()
+		self.clock.stop()
 
 	def run(self):
 		try:
-			self.mpv.on('pause', self._handle_pause)
-			self.mpv.on('unpause', self._handle_unpause)
+			self.clock.start()
 			self._run()
 		except Exception as e:
 			self.log.exception(e)
+		finally:
+			self.clock.stop()
 
 	def _run(self):
-		self.is_paused = self.mpv.command('get_property', 'pause') == 'true'
-		next_messages = []
-		last_start = time.time()
+		self.current_timestamp = self.clock.time()
+		self._restart(int(self.current_timestamp))
 		while not self.stop_requested.is_set():
-			# Re-sync time if needed.
-			time_since_sync = abs(self.current_timestamp - self.last_sync)
-			if time_since_sync >= TwitchChatPrinter.MPV_SYNC_INTERVAL:
-				self.log.debug(f'{time_since_sync} seconds since last sync, resync is needed')
-				old_timestamp = self.current_timestamp
-				self._sync_timestamp()
-				# If the time changed too much, clear the buffer and start anew.
-				if abs(self.current_timestamp - old_timestamp) > TwitchChatPrinter.MAX_CORRECTION_WITHOUT_JUMP:
-					print(f'Time changed too much, jumping from {format_timestamp_ms(old_timestamp)} to {format_timestamp_ms(self.current_timestamp)}')
-					next_messages = []
-					self.buffer = []
-					self.next_request_timestamp = int(self.current_timestamp) - TwitchChatPrinter.MAX_CORRECTION_WITHOUT_JUMP
-
-			# Get the next batch of messages, if needed.
-			if not next_messages:
-				self._ensure_buffer()
-				next_messages = [self.buffer.pop(0)]
-				cutoff_timestamp = max(next_messages[0].timestamp, self.current_timestamp) + TwitchChatPrinter.MIN_RESOLUTION
-				self._ensure_buffer()
-				while self.buffer[0].timestamp <= cutoff_timestamp:
-					next_messages.append(self.buffer.pop(0))
-					self._ensure_buffer()
-				self.log.debug(f'Next batch of messages is at {format_timestamp_ms(next_messages[0].timestamp)}')
-
-			# If it is still too early to print these messages, wait for a bit.
-			time_til_next_message = next_messages[0].timestamp - self.current_timestamp
-			time_til_next_second = 1 - (self.current_timestamp % 1)
-			if time_til_next_second < TwitchChatPrinter.MIN_RESOLUTION:
-				time_til_next_second += 1
-			sleep = min(time_til_next_message, time_til_next_second)
-			if sleep >= TwitchChatPrinter.MIN_RESOLUTION:
-				self._sleep(sleep)
-				self.current_timestamp += sleep
-				self._print_timestamp()
+			# If the time changed too much (e.g. due to a seek), clear the buffer and start anew.
+			old_timestamp = self.current_timestamp
+			self.current_timestamp = self.clock.time()
+			if abs(self.current_timestamp - old_timestamp) > TwitchChatPrinter.MAX_CORRECTION_WITHOUT_JUMP:
+				self._queue_line(
+					f'Time changed too much, jumping from {format_timestamp_ms(old_timestamp)} '
+					f'to {format_timestamp_ms(self.current_timestamp)}'
+				)
+				self._restart(int(self.current_timestamp) - TwitchChatPrinter.MAX_CORRECTION_WITHOUT_JUMP)
+			elif old_timestamp - self.current_timestamp >= PlaybackClock.JUMP_TRESHOLD:
+				# A small step back. The clock redraw and resync were scheduled from the old position, so redo those.
+				self._reschedule_timers()
+
+			# If it is still too early for the next event, wait for it. Waiting ends early if the clock changes (e.g. due
+			# to a pause or a change in speed), after which the wait is recalculated.
+			due, _, event = self.schedule[0]
+			if due - self.current_timestamp >= TwitchChatPrinter.MIN_RESOLUTION:
+				self._flush()
+				# Output that is being collected must be written when collecting ends, even if nothing else happens.
+				max_wait = max(0, self.coalesce_until - time.monotonic()) if self.frame else None
+				self.clock.wait(due - self.current_timestamp, max_wait)
 				continue
 
-			# Print the messages.
-			print('\r', end = '', flush = True)
-			for message in next_messages:
-				message.print()
-			next_messages = []
-			self._print_timestamp()
+			heapq.heappop(self.schedule)
+			if event == TwitchChatPrinter.EVENT_BATCH:
+				self._print_batch()
+				# Getting the next batch might have to wait for messages to be loaded, so write this one out first.
+				self._flush()
+				self._schedule_batch()
+			elif event == TwitchChatPrinter.EVENT_CLOCK:
+				self._queue_timestamp(self.clock.time())
+				self._schedule_clock(due)
+			elif event == TwitchChatPrinter.EVENT_RESYNC:
+				self.clock.resync()
+				self._schedule(self.current_timestamp + TwitchChatPrinter.RESYNC_INTERVAL, event)
+			self._flush()
 
 		# Make sure we've moved to the next line. If we don't do this, it's possible that the next print ends up at the
 		# end of our timestamp line.
-		print()
-
-	def _ensure_buffer(self):
-		while not self.buffer:
-			self.buffer += self.twitch[self.next_request_timestamp]
-			self.next_request_timestamp += 1
-
-	def _sync_timestamp(self):
-		old_timestamp = self.current_timestamp
-		self.current_timestamp = float(self.mpv.command('get_property', 'playback-time'))
-		self.last_sync = self.current_timestamp
-		self.log.info(
-			f'(Re)synced time with video, adjusted {format_timestamp_ms(old_timestamp)} '
-			f'to {format_timestamp_ms(self.current_timestamp)}'
-		)
-
-	def _print_timestamp(self):
-		print(f'\rVideo time: {format_timestamp(self.current_timestamp + 0.05)}', end = '', flush = True)
-
-	def _sleep(self, timeout):
+		self.frame.append('\n')
+		self._flush(force = True)
+
+	def _restart(self, timestamp):
+		""" Start reading messages from the given timestamp, and reset the schedule. """
+		self.buffer.clear()
+		self.cursor = self.twitch.iter_from(timestamp)
+		self.overload.reset()
+		self.schedule = []
+		self._schedule_timers()
+		self._schedule_batch()
+
+	def _schedule_timers(self):
+		""" Schedule the clock redraw and resync, relative to the current position. """
+		self._schedule_clock()
+		self._schedule(self.current_timestamp + TwitchChatPrinter.RESYNC_INTERVAL, TwitchChatPrinter.EVENT_RESYNC)
+
+	def _reschedule_timers(self):
+		""" Replace the scheduled clock redraw and resync with ones relative to the current position. """
+		timers = (TwitchChatPrinter.EVENT_CLOCK, TwitchChatPrinter.EVENT_RESYNC)
+		self.schedule = [entry for entry in self.schedule if entry[2] not in timers]
+		heapq.heapify(self.schedule)
+		self._queue_timestamp(self.current_timestamp)
+		self._schedule_timers()
+
+	def _schedule(self, timestamp, event):
+		heapq.heappush(self.schedule, (timestamp, next(self.schedule_counter), event))
+
+	def _schedule_clock(self, after = None):
 		"""
-		Sleeps for the given amount of playback time.
+		Schedule a clock redraw for when the shown second changes.
 
-		This means that this sleep will be longer than the given timeout if the playback is paused.
+		Events are handled up to MIN_RESOLUTION early, so when rescheduling after a redraw the next one is based on when
+		the previous one was due, as it would otherwise be scheduled at the same time again.
 		"""
-		start = time.time()
-
-		def are_we_done_yet():
-			""" Check how much time has elapsed, and how much longer (if any) we have to sleep for. """
-			nonlocal start, timeout
-			end = time.time()
-			if self.stop_requested.is_set():
-				return True
-			if start > end:
-				# System time changed, so let's just call it good for this sleep, as we have no idea of how long we
-				# actually slept for.
-				return True
-			timeout -= end - start
-			if timeout < TwitchChatPrinter.MIN_RESOLUTION:
-				return True
-			start = end
-			return False
-
-		while timeout > TwitchChatPrinter.MIN_RESOLUTION:
-			if not self.pause_cond.acquire(timeout = timeout):
-				return
-			try:
-				if are_we_done_yet():
-					return
-				if not self.pause_cond.wait_for(lambda: self.is_paused, timeout = timeout):
-					return
-				if are_we_done_yet():
-					return
-				# Timeout was not hit, which means the condition (being paused) was met, so wait for unpause. This does not
-				# count towards the timeout being hit, as the playback time is not progressing.
-				self.log.debug('Waiting for video to be unpaused')
-				self.pause_cond.wait_for(lambda: not self.is_paused)
-				start = time.time()
-			finally:
-				self.pause_cond.release()
-
-	def _handle_pause(self, data):
-		with self.pause_cond:
-			self.log.debug('Video is resumed')
-			self.is_paused = True
-			self.pause_cond.notify_all()
-
-	def _handle_unpause(self, data):
-		with self.pause_cond:
-			self.log.debug('Video is paused')
-			self.is_paused = False
-			self.last_sync = float('-inf')
-			self.pause_cond.notify_all()
+		timestamp = self.current_timestamp if after is None else max(after, self.current_timestamp)
+		self._schedule(math.floor(timestamp + 0.05) + 0.95, TwitchChatPrinter.EVENT_CLOCK)
+
+	def _schedule_batch(self):
+		""" Get the next batch of messages, and schedule printing it. """
+		if not self._ensure_buffer():
+			self.next_messages = []
+			return
+		self.next_messages = [self.buffer.popleft()]
+		cutoff_timestamp = max(self.next_messages[0].timestamp, self.current_timestamp) + TwitchChatPrinter.MIN_RESOLUTION
+		while self._ensure_buffer() and self.buffer[0].timestamp <= cutoff_timestamp:
+			self.next_messages.append(self.buffer.popleft())
+		self.log.debug(f'Next batch of messages is at {format_timestamp_ms(self.next_messages[0].timestamp)}')
+		self._schedule(self.next_messages[0].timestamp, TwitchChatPrinter.EVENT_BATCH)
+
+	def _print_batch(self):
+		""" Print the current batch, or as many of its messages as the overload policy allows if we're lagging behind. """
+		timestamp = self.next_messages[0].timestamp
+		lag = self.clock.time() - timestamp
+		RENDER_LAG.observe(max(lag, 0))
+		PRINTED_MESSAGES.inc(len(self.next_messages))
+		self.overload.record_lag(lag)
+		for line in self.overload.apply(timestamp, self.next_messages):
+			self._queue_line(line)
+		self._queue_timestamp(self.current_timestamp)
 
+	def _ensure_buffer(self):
+		""" Make sure the buffer has at least one message. Returns False if there are no more messages. """
+		if not self.buffer:
+			message = next(self.cursor, None)
+			if message is None:
+				return False
+			self.buffer.append(message)
+		return True
+
+	def _queue_line(self, line):
+		""" Add a line to the output, replacing the clock line. """
+		if self.clock_line is not None:
+			if self.frame and self.frame[-1] == self.clock_line:
+				# The clock line has not been written yet, so there is no need to write it at all.
+				self.frame.pop()
+			self.frame.append('\r')
+			self.clock_line = None
+		self.frame.append(line)
+		self.frame.append('\n')
+
+	def _queue_timestamp(self, timestamp):
+		""" Add the clock line to the output, unless it would not change what is shown. """
+		line = f'\rVideo time: {format_timestamp(timestamp + 0.05)}'
+		if line == self.clock_line:
+			return
+		if self.clock_line is not None and self.frame and self.frame[-1] == self.clock_line:
+			# The previous clock line has not been written yet, so it can be replaced.
+			self.frame.pop()
+		self.frame.append(line)
+		self.clock_line = line
+
+	def _flush(self, force = False):
+		""" Write the output with a single write, unless output is being collected because the terminal is lagging. """
+		if not self.frame:
+			return
+		now = time.monotonic()
+		if now < self.coalesce_until and not force:
+			return
+		data = ''.join(self.frame)
+		self.frame.clear()
+		sys.stdout.write(data)
+		sys.stdout.flush()
+		duration = time.monotonic() - now
+		WRITE_DURATION.observe(duration)
+		if duration > TwitchChatPrinter.LAGGING_WRITE_DURATION:
+			self.log.debug(f'Writing {len(data)} characters took {duration:.3f}s, collecting output for a while')
+			self.coalesce_until = now + duration + min(TwitchChatPrinter.MAX_COALESCE, duration * 2)
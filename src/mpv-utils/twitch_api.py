@@ -0,0 +1,184 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Configurable
+import _logging as logging
+import metrics
+
+
+REQUEST_DURATION = metrics.histogram('twitch_api_request_seconds', 'Duration of requests to the Twitch API, by status.')
+RATE_LIMIT_WAIT = metrics.histogram('twitch_api_rate_limit_wait_seconds', 'Time spent waiting for the rate limiter.')
+RETRIES = metrics.counter('twitch_api_retries_total', 'Requests to the Twitch API that were retried, by reason.')
+
+
+class TokenBucket(object):
+	"""
+	A token bucket rate limiter.
+
+	Tokens are added at a fixed rate, up to a maximum of capacity. Each request takes a token, waiting for one to become
+	available if there are none. The rate can be adjusted based on the rate limit information the server sends back.
+	"""
+
+	def __init__(self, rate, capacity):
+		self.lock = threading.Lock()
+		self.default_rate = rate
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		# The time.monotonic() before which no requests should be made at all.
+		self.blocked_until = 0
+
+	def acquire(self):
+		""" Take a token, waiting until one is available. """
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self._refill(now)
+				if now >= self.blocked_until and self.tokens >= 1:
+					self.tokens -= 1
+					return
+				delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+			time.sleep(delay)
+
+	def update(self, limit, remaining, reset):
+		"""
+		Adapt to the rate limit reported by the server.
+
+		This spreads the requests that are remaining until the reset time (in seconds from now) evenly over that time, but
+		never goes faster than the configured rate.
+		"""
+		with self.lock:
+			self._refill(time.monotonic())
+			self.tokens = min(self.tokens, remaining)
+			if reset > 0 and remaining < limit:
+				self.rate = max(min(self.default_rate, remaining / reset), 1 / reset)
+			else:
+				self.rate = self.default_rate
+
+	def block(self, delay):
+		""" Stop handing out tokens for the given amount of seconds. """
+		with self.lock:
+			self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+			self.tokens = 0
+
+	def _refill(self, now):
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+
+class TwitchClient(Configurable):
+	"""
+	A client for the Twitch API, shared by everything that talks to it.
+
+	This keeps connections to the API alive between requests, limits the rate of requests with a token bucket, and
+	retries requests that fail because of rate limiting or server errors. It is safe to use from multiple threads.
+
+	Use TwitchClient.get() to get the shared instance.
+	"""
+
+	# The base URL of the API. This can be changed to point to a local server for testing.
+	BASE_URL = 'https://api.twitch.tv/v5'
+
+	# The maximum amount of connections to keep open at once.
+	MAX_CONNECTIONS = 8
+
+	# The timeout (in seconds) for a single request.
+	TIMEOUT = 10
+
+	# The delay (in seconds) before the first retry. Each next retry waits twice as long, with random jitter.
+	RETRY_DELAY = 0.5
+	RETRY_DELAY_MAX = 30
+
+	instance = None
+	instance_lock = threading.Lock()
+
+	def __init__(self, base_url = None):
+		self.log = logging.getLogger(__name__, TwitchClient)
+
+		self.base_url = base_url or TwitchClient.BASE_URL
+		self.limiter = TokenBucket(self.rate_limit, self.rate_limit_burst)
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = TwitchClient.MAX_CONNECTIONS)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+		self.session.headers.update({
+			'Client-ID': self.client_id,
+			'Accept': 'application/vnd.twitchtv.v5+json',
+			'Accept-Encoding': 'gzip, deflate',
+		})
+
+	@classmethod
+	def configure(cls, config):
+		cls.client_id = config.get_str('twitch', 'client_id')
+		cls.rate_limit = config.get_float('twitch', 'rate_limit')
+		cls.rate_limit_burst = config.get_int('twitch', 'rate_limit_burst')
+		cls.max_retries = config.get_int('twitch', 'max_retries')
+
+	@classmethod
+	def get(cls):
+		""" Get the shared client, creating it if needed. """
+		with cls.instance_lock:
+			if cls.instance is None:
+				cls.instance = cls()
+			return cls.instance
+
+	def get_json(self, path, params = None):
+		""" Perform a GET request for the given path (relative to the base URL), and return the decoded response. """
+		url = f'{self.base_url}/{path}'
+		attempt = 0
+		while True:
+			started = time.monotonic()
+			self.limiter.acquire()
+			sent = time.monotonic()
+			RATE_LIMIT_WAIT.observe(sent - started)
+			try:
+				response = self.session.get(url, params = params, timeout = TwitchClient.TIMEOUT)
+			except (requests.ConnectionError, requests.Timeout) as e:
+				REQUEST_DURATION.observe(time.monotonic() - sent, status = 'error')
+				if attempt >= self.max_retries:
+					raise
+				delay = self._get_retry_delay(attempt)
+				self.log.warn(f'Request to {url} failed ({e}), retrying in {delay:.2f}s')
+				RETRIES.inc(reason = 'error')
+			else:
+				REQUEST_DURATION.observe(time.monotonic() - sent, status = response.status_code)
+				self._update_limiter(response)
+				if response.status_code != 429 and response.status_code < 500 or attempt >= self.max_retries:
+					response.raise_for_status()
+					return response.json()
+				delay = self._get_retry_delay(attempt, response)
+				self.log.warn(f'Request to {url} failed with status {response.status_code}, retrying in {delay:.2f}s')
+				RETRIES.inc(reason = response.status_code)
+				if response.status_code == 429:
+					# Hold back all requests, not just this one, as they would all be rejected anyway.
+					self.limiter.block(delay)
+			time.sleep(delay)
+			attempt += 1
+
+	def _get_retry_delay(self, attempt, response = None):
+		""" Determine how long to wait before retrying, preferring what the server asked for if it did. """
+		if response is not None:
+			try:
+				if 'Retry-After' in response.headers:
+					return float(response.headers['Retry-After'])
+				if response.status_code == 429 and 'Ratelimit-Reset' in response.headers:
+					return max(0, float(response.headers['Ratelimit-Reset']) - time.time())
+			except ValueError:
+				pass
+		delay = min(TwitchClient.RETRY_DELAY_MAX, TwitchClient.RETRY_DELAY * 2 ** attempt)
+		return random.uniform(delay / 2, delay)
+
+	def _update_limiter(self, response):
+		""" Adapt the rate limiter to the rate limit headers in the response, if present. """
+		try:
+			limit = int(response.headers['Ratelimit-Limit'])
+			remaining = int(response.headers['Ratelimit-Remaining'])
+			reset = float(response.headers['Ratelimit-Reset']) - time.time()
+		except (KeyError, ValueError):
+			return
+		self.limiter.update(limit, remaining, reset)
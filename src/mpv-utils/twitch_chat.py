@@ -1,21 +1,45 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import json
-import requests
 import threading
 import time
 import weakref
 
 import colr
 
+from chat_cache import ChatCache
 from config import Configurable
 import _logging as logging
+import metrics
 from symbols import BADGES
+from twitch_api import TwitchClient
 from utils import format_timestamp
 
 
+SEGMENT_FETCH_DURATION = metrics.histogram(
+	'twitch_chat_segment_fetch_seconds',
+	'Time taken to fetch all messages of a segment from the Twitch API.',
+)
+PAGE_SIZE = metrics.histogram(
+	'twitch_chat_page_messages',
+	'Amount of messages per page returned by the Twitch API.',
+	metrics.SIZE_BUCKETS,
+)
+LOADED_MESSAGES = metrics.counter('twitch_chat_loaded_messages_total', 'Messages loaded, by where they were loaded from.')
+BUFFERED_MESSAGES = metrics.gauge('twitch_chat_buffered_messages', 'Messages currently kept in memory.')
+TIME_AHEAD = metrics.gauge('twitch_chat_ahead_seconds', 'Seconds after the playback position for which chat is loaded.')
+
+
 class TwitchCommenter(object):
 	""" A class representing a Twitch chat member. """
 
+	__slots__ = ('id', 'name', '__weakref__')
+
 	INSTANCES = weakref.WeakValueDictionary()
+	INSTANCES_LOCK = threading.Lock()
 
 	def __init__(self, data):
 		self.id = data['_id']
@@ -27,28 +51,40 @@ class TwitchCommenter(object):
 		try:
 			return cls.INSTANCES[_id]
 		except KeyError:
-			cls.INSTANCES[_id] = instance = cls(data)
-			return instance
+			# Messages are prepared on multiple threads, so make sure only one instance per commenter is kept.
+			with cls.INSTANCES_LOCK:
+				return cls.INSTANCES.setdefault(_id, cls(data))
 
 	def __repr__(self):
 		return f'TwitchCommenter<id={repr(self.id)},name={repr(self.name)}>'
 
 
-class TwitchMessage(object):
-	""" A class representing a Twitch chat message. """
+class TwitchMessage(Configurable):
+	"""
+	A class representing a Twitch chat message.
 
-	def __init__(self, data):
-		self.id = data['_id']
-		self.timestamp = data['content_offset_seconds']
-		message = data['message']
-		self.message = message['body']
-		badge_ids = [badge['_id'] for badge in message.get('user_badges', [])]
-		self.badges = [BADGES[_id] for _id in badge_ids if _id in BADGES]
-		self.commenter = TwitchCommenter.get(data['commenter'])
-		if 'user_color' in message:
-			self.color = self._shift_color(colr.hex2rgb(message['user_color']))
-		else:
-			self.color = 'white'
+	These are not used for storage (see MessageStore), but are created on demand when messages are retrieved.
+	"""
+
+	__slots__ = ('id', 'timestamp', 'message', 'badges', 'commenter', 'color', 'line')
+
+	# The bit used for each known badge in a badge bitmask.
+	BADGE_BITS = { _id: 1 << i for i, _id in enumerate(BADGES) }
+
+	# The colors that have been used so far, so that each color is only parsed once and is shared between messages.
+	COLORS = {}
+
+	# The background color of the terminal, as configured.
+	background = 'unknown'
+
+	def __init__(self, id, timestamp, message, badges, commenter, color, line):
+		self.id = id
+		self.timestamp = timestamp
+		self.message = message
+		self.badges = badges
+		self.commenter = commenter
+		self.color = color
+		self.line = line
 
 	@classmethod
 	def configure(cls, config):
@@ -56,7 +92,44 @@ class TwitchMessage(object):
 		if background == 'light':
 			cls._shift_color = cls._shift_color_light
 		elif background == 'dark':
-			cls._shift_color = cls._shift_color_light
+			cls._shift_color = cls._shift_color_dark
+		cls.background = background
+		cls.COLORS.clear()
+
+	@classmethod
+	def render(cls, timestamp, badges, commenter, color, body):
+		""" Render a message to the line that will be printed for it. """
+		return (
+			f'{format_timestamp(timestamp)} '
+			f'<{_render_badges(badges)}{_render_commenter(commenter, color, cls.background)}> '
+			f'{body}'
+		)
+
+	@classmethod
+	def get_color(cls, user_color):
+		""" Get the color to use for the given user color (a hex string, or None if the user has no color). """
+		try:
+			return cls.COLORS[user_color]
+		except KeyError:
+			if user_color is None:
+				color = 'white'
+			else:
+				color = cls._shift_color(colr.hex2rgb(user_color))
+			cls.COLORS[user_color] = color
+			return color
+
+	@classmethod
+	def encode_badges(cls, user_badges):
+		""" Convert the user badges of a message to a bitmask. Unknown badges are dropped. """
+		mask = 0
+		for badge in user_badges:
+			mask |= cls.BADGE_BITS.get(badge['_id'], 0)
+		return mask
+
+	@classmethod
+	def decode_badges(cls, mask):
+		""" Convert a bitmask created by encode_badges to a list of badge symbols. """
+		return [BADGES[_id] for _id, bit in cls.BADGE_BITS.items() if mask & bit]
 
 	@staticmethod
 	def _shift_color(color):
@@ -71,11 +144,7 @@ class TwitchMessage(object):
 		return tuple(c * 0.75 for c in color)
 
 	def print(self):
-		print(
-			f'{format_timestamp(self.timestamp)} '
-			f'<{"".join(self.badges)}{colr.color(self.commenter.name, fore = self.color)}> '
-			f'{self.message}'
-		)
+		print(self.line)
 
 	def __repr__(self):
 		return (
@@ -84,21 +153,342 @@ class TwitchMessage(object):
 		)
 
 
-class TwitchChat(threading.Thread, Configurable):
-	""" A class representing the chat for a given VOD. """
+@lru_cache(maxsize = 64)
+def _render_badges(mask):
+	""" Render the badges in a badge bitmask. """
+	return ''.join(TwitchMessage.decode_badges(mask))
+
+
+@lru_cache(maxsize = 4096)
+def _render_commenter(commenter, color, background):
+	"""
+	Render the name of a commenter in their color.
+
+	The background is not used directly, but it is part of the cache key as it affects the color the name is shown in.
+	"""
+	return colr.color(commenter.name, fore = color)
+
+
+class MessageStore(object):
+	"""
+	Compact storage for Twitch chat messages, in chronological order.
+
+	The fields of the messages are stored in separate columns rather than in an object per message. Timestamps and badges
+	(as bitmasks) are stored in arrays, and commenters and colors are shared between all messages that use them.
+	Retrieving messages (by index or slice) creates TwitchMessage objects for them.
+
+	Messages are rendered to the line that will be printed for them when they are added, so that this is done while
+	loading rather than while printing.
+	"""
+
+	def __init__(self):
+		self.ids = []
+		self.timestamps = array('d')
+		self.bodies = []
+		self.commenters = []
+		self.badges = array('L')
+		self.colors = []
+		self.lines = []
+
+	def _columns(self):
+		return (self.ids, self.timestamps, self.bodies, self.commenters, self.badges, self.colors, self.lines)
+
+	def __len__(self):
+		return len(self.ids)
+
+	@staticmethod
+	def prepare(data):
+		"""
+		Convert a message in the format returned by the Twitch API to a row that can be added with append.
+
+		This does all the work needed to add a message, so that it can be done on a different thread than the one adding
+		the messages.
+		"""
+		message = data['message']
+		timestamp = data['content_offset_seconds']
+		body = message['body']
+		commenter = TwitchCommenter.get(data['commenter'])
+		badges = TwitchMessage.encode_badges(message.get('user_badges', []))
+		color = TwitchMessage.get_color(message.get('user_color'))
+		line = TwitchMessage.render(timestamp, badges, commenter, color, body)
+		return (data['_id'], timestamp, body, commenter, badges, color, line)
+
+	def append(self, row):
+		""" Add a message, as prepared by prepare. """
+		_id, timestamp, body, commenter, badges, color, line = row
+		self.ids.append(_id)
+		self.timestamps.append(timestamp)
+		self.bodies.append(body)
+		self.commenters.append(commenter)
+		self.badges.append(badges)
+		self.colors.append(color)
+		self.lines.append(line)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self._get(i) for i in range(*index.indices(len(self)))]
+		return self._get(index)
+
+	def __delitem__(self, index):
+		for column in self._columns():
+			del column[index]
+
+	def _get(self, i):
+		return TwitchMessage(
+			self.ids[i],
+			self.timestamps[i],
+			self.bodies[i],
+			TwitchMessage.decode_badges(self.badges[i]),
+			self.commenters[i],
+			self.colors[i],
+			self.lines[i],
+		)
+
+
+class TimeIndex(object):
+	"""
+	An index of the seconds that have messages in a chronologically ordered list of messages.
+
+	For each second that has messages this stores the position of its first message. Positions are counted from the
+	first message that was ever added, and an offset is kept for messages that have since been removed from the front of
+	the list, so that removing messages does not require updating all positions.
+	"""
+
+	def __init__(self):
+		# The seconds that have messages, in ascending order, and the (absolute) position of the first message of each.
+		# Entries before head have been trimmed, and are removed in bulk once enough of them have accumulated.
+		self.seconds = []
+		self.starts = []
+		self.head = 0
+		# The amount of messages that have been trimmed and the amount of messages that have been added.
+		self.offset = 0
+		self.length = 0
+
+	def __bool__(self):
+		return self.head < len(self.seconds)
+
+	def first(self):
+		""" The first second that has messages. """
+		return self.seconds[self.head]
+
+	def last(self):
+		""" The last second that has messages. """
+		return self.seconds[-1]
+
+	def append(self, timestamp):
+		""" Add a message at the end of the list. """
+		second = int(timestamp)
+		# Messages should be in chronological order, but if one isn't, just count it as part of the last second.
+		if not self or second > self.seconds[-1]:
+			self.seconds.append(second)
+			self.starts.append(self.length)
+		self.length += 1
+
+	def trim(self, count):
+		""" Remove messages from the front of the list. """
+		self.offset = min(self.offset + count, self.length)
+		while self.head < len(self.seconds) and self._end(self.head) <= self.offset:
+			self.head += 1
+		if self.head < len(self.seconds):
+			self.starts[self.head] = max(self.starts[self.head], self.offset)
+		if self.head > len(self.seconds) // 2:
+			del self.seconds[:self.head]
+			del self.starts[:self.head]
+			self.head = 0
+
+	def slice(self, second):
+		""" Get the start (inclusive) and end (exclusive) index of the messages in the given second. """
+		i = bisect_left(self.seconds, second, self.head)
+		if i == len(self.seconds) or self.seconds[i] != second:
+			return (0, 0)
+		return (self.starts[i] - self.offset, self._end(i) - self.offset)
+
+	def next_second(self, second):
+		""" Get the first second at or after the given second that has messages, or None if there is none. """
+		i = bisect_left(self.seconds, second, self.head)
+		if i == len(self.seconds):
+			return None
+		return self.seconds[i]
+
+	def next_index(self, second):
+		""" Get the index of the first message at or after the given second. """
+		i = bisect_left(self.seconds, second, self.head)
+		if i == len(self.seconds):
+			return self.length - self.offset
+		return self.starts[i] - self.offset
+
+	def _end(self, i):
+		return self.starts[i + 1] if i + 1 < len(self.starts) else self.length
+
+
+class MessageChunk(object):
+	"""
+	A contiguous range of loaded messages.
+
+	All messages between start and end (both inclusive, in whole seconds) are known to be loaded. The messages may extend
+	a bit beyond end, as the messages of the last second might not all be loaded yet.
+	"""
+
+	def __init__(self, start):
+		self.log = logging.getLogger(__name__, MessageChunk)
+
+		self.messages = MessageStore()
+		self.time_index = TimeIndex()
+		self.start = start
+		self.end = start - 1
+
+	def __len__(self):
+		return len(self.messages)
+
+	def __repr__(self):
+		end = 'end' if self.end == float('inf') else format_timestamp(self.end)
+		return f'MessageChunk<{format_timestamp(self.start)} - {end},messages={len(self)}>'
+
+	def covers(self, second):
+		return self.start <= second <= self.end
+
+	def distance(self, second):
+		""" The distance (in seconds) between the given second and this chunk. """
+		return max(0, self.start - second, second - self.end)
+
+	def messages_ahead(self, second):
+		""" The amount of messages at or after the given second. """
+		return len(self.messages) - self.time_index.next_index(second)
+
+	def get(self, second):
+		""" Get the messages in the given second. """
+		start, end = self.time_index.slice(second)
+		return self.messages[start:end]
+
+	def add(self, rows):
+		""" Add messages (as prepared by MessageStore.prepare) to the end of the chunk. """
+		# The API appears to return some more messages than needed, at least on the first request. Drop all messages that
+		# we already have.
+		if self.messages and rows and rows[0][1] <= self.messages.timestamps[-1]:
+			last_id = self.messages.ids[-1]
+			self.log.info(f'Possible duplicate messages, dropping messages until we find message {last_id}')
+			for i, row in enumerate(rows):
+				if row[0] == last_id:
+					del rows[:i + 1]
+					self.log.info(
+						f'Found last known message in new received list at position {i}. '
+						f'Dropping everything up to and including this message, keeping {len(rows)}.'
+					)
+					break
+			else:
+				self.log.warn(
+					f"Unable to find last known message in the received list. Keeping all messages. "
+					"It's possible this means duplicates were kept."
+				)
+
+		for row in rows:
+			self.messages.append(row)
+			self.time_index.append(row[1])
+
+	def extend(self, other):
+		""" Merge a chunk that starts at or before the end of this chunk into it. """
+		# Drop the messages that the other chunk also has. These are all in seconds that are also covered by the other
+		# chunk, so there is no need to compare individual messages.
+		cutoff = self.time_index.next_index(other.start)
+		del self.messages[cutoff:]
+		for column, other_column in zip(self.messages._columns(), other.messages._columns()):
+			column.extend(other_column)
+		self.time_index = TimeIndex()
+		for timestamp in self.messages.timestamps:
+			self.time_index.append(timestamp)
+		self.end = max(self.end, other.end)
+
+	def trim_before(self, second):
+		""" Remove all messages before the given second. """
+		if second <= self.start:
+			return 0
+		count = self.time_index.next_index(second)
+		del self.messages[:count]
+		self.time_index.trim(count)
+		self.start = second
+		return count
+
+
+class LoadController(object):
+	"""
+	Decides how much chat to load ahead, based on how busy the chat is and how fast it can be fetched.
+
+	Everything is expressed in seconds of playback rather than in messages. The chat density (messages per second) is
+	measured from the loaded messages, and the fetch rate (seconds of playback fetched per second) from the fetches. Both
+	are tracked as exponential moving averages.
+	"""
+
+	# The weight of a new measurement in the moving averages.
+	SMOOTHING = 0.3
+
+	# The minimum amount of time (in seconds) to have loaded ahead before more is loaded, and the minimum amount of time
+	# to load ahead when loading. The treshold is raised if fetching is slow, so that there is enough time to fetch more
+	# before the loaded messages run out.
+	MIN_LOAD_MORE_TRESHOLD = 30
+	MIN_LOAD_AHEAD = 120
+	LATENCY_MARGIN = 3
+
+	# The minimum amount of time (in seconds) of old messages to keep in the chunk that is currently being played, as long
+	# as this fits within the buffer.
+	KEEP_BEHIND = 120
+
+	# The fraction of the buffer that may be used for messages ahead of the current position.
+	MAX_AHEAD_FRACTION = 0.5
+
+	# The amount of messages to aim for in a single fetched segment, and the bounds of the segment length (in seconds).
+	SEGMENT_MESSAGES = 200
+	MIN_SEGMENT_LENGTH = 5
+	MAX_SEGMENT_LENGTH = 300
+
+	def __init__(self, max_messages):
+		self.max_messages = max_messages
+		# Start out assuming a moderately busy chat that can be fetched at a reasonable speed.
+		self.density = 2.0
+		self.fetch_rate = 60.0
+
+	def __repr__(self):
+		return f'LoadController<density={self.density:.2f}/s,fetch_rate={self.fetch_rate:.1f}s/s>'
+
+	def record_messages(self, seconds, count):
+		""" Record that the given amount of messages were loaded for the given amount of seconds. """
+		if seconds > 0:
+			self.density += (count / seconds - self.density) * LoadController.SMOOTHING
+
+	def record_fetch(self, seconds, duration):
+		""" Record that fetching the given amount of seconds took the given (wall clock) duration. """
+		if seconds > 0 and duration > 0:
+			self.fetch_rate += (seconds / duration - self.fetch_rate) * LoadController.SMOOTHING
+
+	def load_more_treshold(self):
+		""" The amount of seconds ahead below which more should be loaded. """
+		fetch_time = LoadController.MIN_LOAD_AHEAD / self.fetch_rate
+		treshold = max(LoadController.MIN_LOAD_MORE_TRESHOLD, fetch_time * LoadController.LATENCY_MARGIN)
+		return min(treshold, self._max_load_ahead() / 2)
 
-	# The amount of time (in seconds) before the last message is reached that we will start loading more messages.
-	LOAD_MORE_TRESHOLD = 30
+	def load_ahead(self):
+		""" The amount of seconds to have loaded ahead when loading. """
+		return min(max(LoadController.MIN_LOAD_AHEAD, self.load_more_treshold() * 2), self._max_load_ahead())
 
-	# The minimum amount of old (that is, before the last requested timestamp) messages to keep. It is possible that
-	# more messages are kept at times (or less, if less messages than this exist). Can be useful to prevent having to
-	# re-load all messages when a backwards jump in time happens.
-	KEEP_MESSAGES_BEHIND = 500
+	def _max_load_ahead(self):
+		""" The amount of seconds ahead that fit in the part of the buffer that is meant for messages ahead. """
+		return self.max_messages * LoadController.MAX_AHEAD_FRACTION / max(self.density, 0.01)
 
-	# The amount of messages to have that lie in the future (that is, after the last requested timestamp) when loading
-	# more messages. It's possible that less (or slightly more) messages than this exist at any time, but this is the
-	# target when loading more.
-	LOAD_MESSAGES_AHEAD = 1000
+	def messages_for(self, seconds):
+		""" The expected amount of messages in the given amount of seconds. """
+		return int(seconds * self.density) + 1
+
+	def segment_length(self):
+		""" The length (in seconds) of the segments to fetch concurrently. """
+		length = LoadController.SEGMENT_MESSAGES / max(self.density, 0.01)
+		return int(min(LoadController.MAX_SEGMENT_LENGTH, max(LoadController.MIN_SEGMENT_LENGTH, length)))
+
+
+class TwitchChat(threading.Thread, Configurable):
+	""" A class representing the chat for a given VOD. """
+
+	# The amount of segments to fetch concurrently when loading messages that are not cached. This is also the maximum
+	# amount of segments that can be fetched but not yet added.
+	PREFETCH_SEGMENTS = 4
 
 	def __init__(self, vodid, start = 0):
 		super(TwitchChat, self).__init__()
@@ -108,201 +498,392 @@ class TwitchChat(threading.Thread, Configurable):
 		self.vodid = vodid
 		self.stop_requested = threading.Event()
 
-		# The messages are stores in a list, in chronological order. The time_slices variable is a mapping of timestamp
-		# (rounded down to the second) to the index of the first message and last message in that second.
+		# The messages are stored in chunks, each of which is a contiguous range of loaded messages. The chunks are in
+		# chronological order, and do not overlap.
 		self.lock = threading.RLock()
 		self.data_loaded = threading.Condition()
 		self.needs_loading = threading.Condition()
-		self.messages = []
-		self.time_slices = {}
-		self.loaded_range = (-1, -1)
+		self.chunks = []
 		self.last_requested_position = start
+		self.controller = LoadController(self.max_buffered_messages)
+		self.cache = None
+		self.pool = None
 
 	@classmethod
 	def configure(cls, config):
-		cls.client_id = config.get_str('twitch', 'client_id')
+		cls.max_buffered_messages = config.get_int('twitch', 'max_buffered_messages')
 
 	def stop(self):
 		self.stop_requested.set()
 		with self.needs_loading:
 			self.needs_loading.notify()
+		self._notify_loaded()
 
 	def run(self):
 		try:
 			self._run()
 		except Exception as e:
 			self.log.exception(e)
+		finally:
+			# Nothing will be loaded anymore, so don't let requests wait for it.
+			self.stop_requested.set()
+			self._notify_loaded()
 
 	def _run(self):
+		self.cache = ChatCache.open()
+		self.pool = ThreadPoolExecutor(max_workers = TwitchChat.PREFETCH_SEGMENTS)
+		try:
+			self._run_loop()
+		finally:
+			self.pool.shutdown(wait = False)
+			if self.cache:
+				self.cache.close()
+
+	def _run_loop(self):
 		while not self.stop_requested.is_set():
 			# Check whether we need to load more messages
-			if self.last_requested_position + TwitchChat.LOAD_MORE_TRESHOLD >= self.loaded_range[1]:
+			if self._get_time_ahead() < self.controller.load_more_treshold():
 				self._load_more()
+			self._clean_stored_messages()
 			if self.stop_requested.is_set():
 				return
 
-			# Wait until a sufficient amount of time has passed, but allow earlier triggering by use of a condition.
-			self.log.debug('Waiting for timer/interrupt')
+			# Wait until we get close to the treshold, but allow earlier triggering by use of a condition.
+			time_ahead = self._get_time_ahead()
+			TIME_AHEAD.set(time_ahead)
+			timeout = min(30, max(1, time_ahead - self.controller.load_more_treshold()))
+			self.log.debug(f'Waiting for timer ({timeout}s)/interrupt')
 			with self.needs_loading:
-				self.needs_loading.wait(30)
+				self.needs_loading.wait(timeout)
 			self.log.debug('Checking whether we need to load more')
 
 	def __getitem__(self, timestamp):
-		# Load more if the timestamp is outside of what is currently loaded.
-		if timestamp not in range(self.loaded_range[0], self.loaded_range[1] + 1):
-			self.log.info(
-				f'Requested timestamp ({format_timestamp(timestamp)}) is outside of the loaded range '
-				f'{format_timestamp(self.loaded_range[0])} - {format_timestamp(self.loaded_range[1])}, '
-				'sending interrupt to load more'
-			)
-			with self.lock:
-				self.last_requested_position = timestamp
-			with self.data_loaded:
-				with self.needs_loading:
-					self.needs_loading.notify()
-				self.log.debug(f'Waiting for requested timestamp ({format_timestamp(timestamp)}) to become available')
-				self.data_loaded.wait_for(lambda: timestamp in range(self.loaded_range[0], self.loaded_range[1] + 1))
-			self.log.debug(f'Requested timestamp ({format_timestamp(timestamp)}) has become available, proceeding')
+		return self._read(timestamp, lambda chunk: chunk.get(timestamp), [])
 
-		with self.lock:
-			slice = self.time_slices.get(timestamp, (0, -1))
-			return self.messages[slice[0]:slice[1] + 1]
+	def iter_from(self, timestamp):
+		"""
+		Iterate over the messages from the given second onwards, in order.
 
-	def _get_next_timestamp_index(self, time):
+		Seconds without messages are skipped without waiting for them, and the lock is only taken once per second with
+		messages. When messages have not been loaded yet this waits until they are. Iteration ends when the loader stops.
+		"""
+		second = int(timestamp)
+		while second != float('inf'):
+			messages, second = self._read(second, lambda chunk: self._read_next(chunk, second), ([], float('inf')))
+			yield from messages
+
+	def _read_next(self, chunk, second):
+		""" Get the messages of the first second with messages at or after the given second, and the second after it. """
+		next_second = chunk.time_index.next_second(second)
+		if next_second is None or next_second > chunk.end:
+			# No (known) messages in the rest of this chunk.
+			return ([], chunk.end + 1)
+		return (chunk.get(next_second), next_second + 1)
+
+	def _read(self, timestamp, func, default):
 		"""
-		Get the index that messages for the given timestamp start at in the message list.
+		Call func with the chunk that covers the given timestamp (while holding the lock), waiting for it if needed.
 
-		This will return the index for the next message after the given timestamp if none exist at the timestamp itself.
+		Returns default instead if the timestamp is not loaded and the loader has stopped, as it will never be loaded then.
 		"""
 		with self.lock:
-			if not self.time_slices:
+			# Keep track of the position, so that loading and eviction happen relative to it.
+			self.last_requested_position = timestamp
+			chunk = self._get_chunk(timestamp)
+			if chunk:
+				return func(chunk)
+
+		# Load more if the timestamp is outside of what is currently loaded.
+		self.log.info(
+			f'Requested timestamp ({format_timestamp(timestamp)}) is outside of the loaded ranges {self.chunks}, '
+			'sending interrupt to load more'
+		)
+		with self.data_loaded:
+			with self.needs_loading:
+				self.needs_loading.notify()
+			self.log.debug(f'Waiting for requested timestamp ({format_timestamp(timestamp)}) to become available')
+			while True:
+				self.data_loaded.wait_for(lambda: self._get_chunk(timestamp) is not None or self.stop_requested.is_set())
+				if self.stop_requested.is_set():
+					self.log.debug(f'Stopped while waiting for requested timestamp ({format_timestamp(timestamp)})')
+					return default
+				with self.lock:
+					# The chunk might have been evicted again in the meantime, although that is unlikely.
+					chunk = self._get_chunk(timestamp)
+					if chunk:
+						self.log.debug(f'Requested timestamp ({format_timestamp(timestamp)}) is now available, proceeding')
+						return func(chunk)
+
+	def _get_time_ahead(self):
+		""" The amount of seconds after the last requested position that are loaded. """
+		with self.lock:
+			chunk = self._get_chunk(self.last_requested_position)
+			if chunk is None:
 				return 0
-			if time not in self.time_slices:
-				times_ahead = [t for t in self.time_slices.keys() if t > time]
-				if not times_ahead:
-					return len(self.messages)
-				time = min(times_ahead)
-			return self.time_slices[time][0]
-
-	def _update_indexes(self):
-		""" Re-scans the message list and updates the time slices and loaded range based on it. """
+			return chunk.end - self.last_requested_position
+
+	def _get_chunk(self, second):
+		""" Get the chunk that covers the given second, if any. """
 		with self.lock:
-			# Update the time slices.
-			self.time_slices.clear()
-			start_index = -1
-			current_timestamp = -1
-			for i, message in enumerate(self.messages):
-				timestamp = int(message.timestamp)
-				if timestamp != current_timestamp:
-					self.time_slices[current_timestamp] = (start_index, i - 1)
-					start_index = i
-					current_timestamp = timestamp
-			self.time_slices[current_timestamp] = (start_index, i - 1)
-			del self.time_slices[-1]
-
-			slices_debug = sorted(self.time_slices.items(), key = lambda p: p[0])
-			slices_debug = [(format_timestamp(k), v[1] - v[0] + 1) for k, v in slices_debug]
-			self.log.debug(f'Slices: {slices_debug}')
-
-			# Update the loaded range. We subtract one from the highest known timestamp because there is no guarantee
-			# that we have _all_ messages for that timestamp.
-			self.loaded_range = (
-				min(self.last_requested_position, *self.time_slices.keys()),
-				max(self.time_slices.keys()) - 1,
-			)
-			self.log.info(f'Range: {format_timestamp(self.loaded_range[0])} - {format_timestamp(self.loaded_range[1])}')
+			for chunk in self.chunks:
+				if chunk.covers(second):
+					return chunk
+			return None
 
-	def _clean_stored_messages(self):
-		""" Trim the message list to the messages that are still relevant given the current position and settings. """
+	def _get_or_create_chunk(self, second):
+		""" Get the chunk that covers or ends right before the given second, creating a new chunk if there is none. """
 		with self.lock:
-			# If we go back to before the currently loaded range, we simply clear the entire list.
-			# TODO: this is not optimal if we go back to only a little bit before the currently loaded range.
-			if self.last_requested_position < self.loaded_range[0]:
-				del self.messages[:]
-				return
+			for i, chunk in enumerate(self.chunks):
+				if chunk.start <= second <= chunk.end + 1:
+					return chunk
+				if chunk.start > second:
+					break
+			else:
+				i = len(self.chunks)
+			chunk = MessageChunk(int(second))
+			self.chunks.insert(i, chunk)
+			return chunk
+
+	def _extend_chunk(self, chunk, end):
+		"""
+		Mark a chunk as being loaded up to the given second (exclusive), merging it with the next chunk if they meet.
 
-			# Remove old messages beyond the specified buffer.
-			first_index_of_next_timestamp = self._get_next_timestamp_index(self.last_requested_position)
-			cutoff_index = min(first_index_of_next_timestamp - TwitchChat.KEEP_MESSAGES_BEHIND, 0)
-			self.log.info(f'Clearing {cutoff_index} old messages')
-			del self.messages[:cutoff_index]
+		Returns the chunk that now contains the given chunk.
+		"""
+		with self.lock:
+			chunk.end = max(chunk.end, end - 1)
+			i = self.chunks.index(chunk)
+			while i + 1 < len(self.chunks) and self.chunks[i + 1].start <= chunk.end + 1:
+				self.log.info(f'Merging {self.chunks[i + 1]} into {chunk}')
+				chunk.extend(self.chunks.pop(i + 1))
+			self.log.info(f'Loaded ranges: {self.chunks}')
+		return chunk
 
-			# Update the indexes.
-			self._update_indexes()
+	def _clean_stored_messages(self):
+		"""
+		Trim the stored messages to fit within the configured buffer size.
 
-	def _process_messages(self, messages):
-		messages = [TwitchMessage(message) for message in messages]
-		self.log.debug(f'Processing {len(messages)} messages: {messages}')
+		Chunks are evicted furthest from the last requested position first. The chunk the last requested position is in is
+		never evicted, but old messages in it (beyond the time the load controller wants to keep behind) are.
+		"""
 		with self.lock:
-			# The API appears to return some more messages than needed, at least on the first request. Drop all messages
-			# that we already have.
-			if self.messages and messages[0].timestamp < self.messages[-1].timestamp:
-				last_message = self.messages[-1]
-				self.log.info(f'Possible duplicate messages, dropping messages until we find message {last_message}')
-				for i, message in enumerate(messages):
-					if message == last_message:
-						del messages[:i + 1]
-						self.log.info(
-							f'Found last known message in new received list at position {i}. '
-							f'Dropping everything up to and including this message, keeping {len(messages)}.'
-						)
-						break
-				else:
-					self.log.warn(
-						f"Unable to find last known message in the received list. Keeping all messages. "
-						"It's possible this means duplicates were kept."
-					)
-
-			self.messages += messages
-			self._update_indexes()
-		self.log.info(f'Message buffer size: {len(self.messages)}')
-		self.log.debug(f'Message buffer: {self.messages}')
+			position = self.last_requested_position
+			total = sum(len(chunk) for chunk in self.chunks)
+			others = sorted(
+				(chunk for chunk in self.chunks if not chunk.covers(position)),
+				key = lambda chunk: chunk.distance(position),
+			)
+			while total > self.max_buffered_messages and others:
+				chunk = others.pop()
+				self.log.info(f'Evicting {chunk}')
+				self.chunks.remove(chunk)
+				total -= len(chunk)
+
+			current = self._get_chunk(position)
+			if total > self.max_buffered_messages and current:
+				# Keep as much as possible of the time behind the current position, but never more than the buffer allows.
+				cutoff_index = current.time_index.next_index(position - LoadController.KEEP_BEHIND)
+				cutoff_index = max(cutoff_index, total - self.max_buffered_messages)
+				if 0 < cutoff_index < len(current):
+					cutoff = int(current.messages.timestamps[cutoff_index])
+					removed = current.trim_before(cutoff)
+					self.log.info(f'Cleared {removed} old messages')
+					total -= removed
+			BUFFERED_MESSAGES.set(total)
+
+	def _process_messages(self, chunk, rows):
+		self.log.debug(f'Processing {len(rows)} messages')
+		with self.lock:
+			chunk.add(rows)
+			total = sum(len(chunk) for chunk in self.chunks)
+		BUFFERED_MESSAGES.set(total)
+		self.log.info(f'Message buffer size: {total}')
 
-		# Notify listeners that the data has been updated.
+	def _notify_loaded(self):
+		""" Notify listeners that the data has been updated. """
 		with self.data_loaded:
 			self.data_loaded.notify_all()
 
 	def _load_more(self):
-		self.log.info('Starting load')
-		# Determine the amount of messages that need to be loaded to get back to the LOAD_MESSAGES_AHEAD size.
+		self.log.info(f'Starting load ({self.controller})')
 		with self.lock:
-			next_timestamp_index = self._get_next_timestamp_index(self.last_requested_position)
-			num_messages_ahead = max(0, len(self.messages) - next_timestamp_index)
-
-		# Load messages until the amount of loaded messages + the existing buffer bring us to the treshold, or until
-		# there are no more messages.
-		to_load = TwitchChat.LOAD_MESSAGES_AHEAD - num_messages_ahead
-		cursor = None
-		session = requests.Session()
-		session.headers = { 'Client-ID': self.client_id, 'Accept': 'application/vnd.twitchtv.v5+json' }
-
-		def load_with_qargs(qargs):
-			nonlocal cursor, to_load
-			self.log.debug(f'Loading with args {qargs}')
-			response = session.get(f'https://api.twitch.tv/v5/videos/{self.vodid}/comments?{qargs}', timeout = 10)
-			response.raise_for_status()
-			data = response.json()
-			cursor = data['_next']
-			messages = data['comments']
-			to_load -= len(messages)
-			self._process_messages(messages)
-
-		self.log.debug(f'{to_load} messages remaining')
-		start_time = max(self.last_requested_position, self.loaded_range[1] + 1)
-		load_with_qargs(f'content_offset_seconds={start_time}')
-		while cursor and to_load > 0 and not self.stop_requested.is_set():
-			time.sleep(0.1)
-			self.log.debug(f'{to_load} messages remaining')
-			load_with_qargs(f'cursor={cursor}')
-		if not cursor:
-			# This means all messages have been loaded, which means the loaded_range should stretch to the end of the
-			# video.
-			with self.lock:
-				self.loaded_range = (self.loaded_range[0], float('inf'))
-		if self.loaded_range[1] - self.last_requested_position < TwitchChat.LOAD_MORE_TRESHOLD:
+			chunk = self._get_or_create_chunk(self.last_requested_position)
+			target = self.last_requested_position + self.controller.load_ahead()
+		client = TwitchClient.get()
+
+		# Load messages until the chunk reaches the target, or until there are no more messages.
+		stalls = 0
+		while chunk.end < target and not self.stop_requested.is_set():
+			position = chunk.end + 1
+			self.log.debug(f'{target - chunk.end} seconds remaining')
+
+			# Use the cache if it covers the current position. If the returned messages do not make it past a single second
+			# we try again with a higher limit.
+			limit = max(self.controller.messages_for(target - position), LoadController.SEGMENT_MESSAGES) * 2 ** stalls
+			cached = self.cache.get(self.vodid, position, limit) if self.cache else None
+			if cached is not None:
+				messages, end, done = cached
+				self.log.debug(f'Loaded {len(messages)} messages from the cache')
+				LOADED_MESSAGES.inc(len(messages), source = 'cache')
+				self._process_messages(chunk, [MessageStore.prepare(message) for message in messages])
+				chunk = self._loaded_up_to(chunk, position, end, done, len(messages))
+				stalls = stalls + 1 if chunk.end < position else 0
+				continue
+
+			chunk = self._fetch_pipelined(client, chunk, position, target)
+			if chunk.end < position and not self.stop_requested.is_set():
+				self.log.warn(f'Loading made no progress at {format_timestamp(position)}, giving up for now')
+				break
+
+		time_ahead = self._get_time_ahead()
+		TIME_AHEAD.set(time_ahead)
+		if time_ahead < self.controller.load_more_treshold():
 			self.log.warn(
-				f'After filling the message buffer to the max ({TwitchChat.LOAD_MESSAGES_AHEAD}), '
-				f'it only covers up to {self.loaded_range[1] - self.last_requested_position} seconds ahead, '
-				f'which is less than the load-more treshold ({TwitchChat.LOAD_MORE_TRESHOLD})'
+				f'After loading, the message buffer only covers {time_ahead} seconds ahead, '
+				f'which is less than the load-more treshold ({self.controller.load_more_treshold()})'
 			)
-		self.log.info('Finished loading')
+		self.log.info(f'Finished loading ({self.controller})')
+
+	def _fetch_pipelined(self, client, chunk, position, target):
+		"""
+		Fetch messages from position until the target, the end of the VOD or the next chunk is reached.
+
+		This is a pipeline. The pool fetches, decodes and prepares the next couple of segments concurrently, while the
+		messages of earlier segments are added to the chunk on this thread. New segments are only started as earlier ones
+		have been added, so that fetching never gets more than PREFETCH_SEGMENTS segments ahead.
+
+		Returns the chunk that now contains the given chunk.
+		"""
+		if len(chunk) == 0:
+			# Nothing has been loaded here yet, so someone is probably waiting for the first messages.
+			chunk, loaded_until, done = self._fetch_first_page(client, chunk, position)
+			if done or loaded_until is None or chunk.end + 1 != loaded_until or chunk.end >= target:
+				# Either we're done, or we ran into the next chunk or reached the target already.
+				return chunk
+			position = loaded_until
+
+		segment_length = self.controller.segment_length()
+		pending = deque()
+		next_start = position
+		started = time.monotonic()
+		try:
+			while not self.stop_requested.is_set():
+				# Segments end exclusively, so only a segment that ends after the target makes the chunk reach it.
+				while len(pending) < TwitchChat.PREFETCH_SEGMENTS and next_start <= target:
+					end = next_start + segment_length
+					pending.append((next_start, end, self.pool.submit(self._fetch_segment, client, next_start, end)))
+					next_start = end
+				if not pending:
+					break
+
+				start, end, future = pending.popleft()
+				result = future.result()
+				if result is None:
+					# Stopped before the segment was complete.
+					break
+				rows, done = result
+				self.controller.record_fetch(end - position, time.monotonic() - started)
+				self._process_messages(chunk, rows)
+				chunk = self._loaded_up_to(chunk, start, end, done, len(rows))
+				if done or chunk.end + 1 != end:
+					# Either we're done, or we ran into the next chunk, in which case we continue after that chunk.
+					break
+		finally:
+			for _, _, future in pending:
+				future.cancel()
+		return chunk
+
+	def _fetch_first_page(self, client, chunk, position):
+		"""
+		Fetch a single page of messages from position, and add the messages of all complete seconds in it to the chunk.
+
+		A segment is only added once all of its pages have been fetched, which takes a couple of round trips for a busy
+		chat. This makes the first messages available after a single one.
+
+		Returns a tuple of the chunk that now contains the given chunk, the position up to which messages have been
+		loaded (or None if a stop was requested), and whether the end of the VOD was reached.
+		"""
+		if self.stop_requested.is_set():
+			return (chunk, None, False)
+		data = client.get_json(f'videos/{self.vodid}/comments', { 'content_offset_seconds': position })
+		page = data['comments']
+		PAGE_SIZE.observe(len(page))
+		messages = [message for message in page if message['content_offset_seconds'] >= position]
+		done = not data.get('_next')
+		if done:
+			end = None
+		elif messages:
+			# The next page might have more messages in the same second as the last message of this page.
+			end = int(messages[-1]['content_offset_seconds'])
+			messages = [message for message in messages if message['content_offset_seconds'] < end]
+		else:
+			end = position
+		if not done and end <= position:
+			# Not even a single second is complete, so this did not get us anywhere.
+			return (chunk, position, False)
+
+		LOADED_MESSAGES.inc(len(messages), source = 'api')
+		if self.cache:
+			self.cache.store(self.vodid, position, end, messages)
+		self._process_messages(chunk, [MessageStore.prepare(message) for message in messages])
+		chunk = self._loaded_up_to(chunk, position, end, done, len(messages))
+		return (chunk, end, done)
+
+	def _loaded_up_to(self, chunk, start, position, done, count):
+		"""
+		Update a chunk after the messages from start up to the given position (exclusive) have been added to it.
+
+		Returns the chunk that now contains the given chunk.
+		"""
+		if not done:
+			self.controller.record_messages(position - start, count)
+		if done:
+			# This means all messages have been loaded, which means the chunk should stretch to the end of the video.
+			position = float('inf')
+		chunk = self._extend_chunk(chunk, position if done else int(position))
+		self._notify_loaded()
+		return chunk
+
+	def _fetch_segment(self, client, start, end):
+		"""
+		Fetch all messages from start (inclusive) to end (exclusive), store them in the cache, and prepare them.
+
+		Returns a tuple of the prepared messages, and whether the end of the VOD was reached, or None if a stop was requested
+		before all messages were fetched.
+		"""
+		started = time.monotonic()
+		result = self._fetch_segment_messages(client, start, end)
+		if result is None:
+			return None
+		messages, done = result
+		SEGMENT_FETCH_DURATION.observe(time.monotonic() - started)
+		LOADED_MESSAGES.inc(len(messages), source = 'api')
+		if self.cache:
+			self.cache.store(self.vodid, start, None if done else end, messages)
+		return ([MessageStore.prepare(message) for message in messages], done)
+
+	def _fetch_segment_messages(self, client, start, end):
+		"""
+		Fetch all messages from start (inclusive) to end (exclusive), as returned by the Twitch API.
+
+		Returns a tuple of the messages and whether the end of the VOD was reached, or None if a stop was requested before
+		all messages were fetched. Incomplete results must not be used, as that would leave a gap in the messages.
+		"""
+		messages = []
+		params = { 'content_offset_seconds': start }
+		while True:
+			if self.stop_requested.is_set():
+				return None
+			self.log.debug(f'Loading with args {params}')
+			data = client.get_json(f'videos/{self.vodid}/comments', params)
+			cursor = data.get('_next')
+			page = data['comments']
+			PAGE_SIZE.observe(len(page))
+			messages += [message for message in page if message['content_offset_seconds'] >= start]
+			if not cursor:
+				# This is the end of the VOD, so everything after the segment is included as well.
+				return (messages, True)
+			if page and page[-1]['content_offset_seconds'] >= end:
+				break
+			params = { 'cursor': cursor }
+		return ([message for message in messages if message['content_offset_seconds'] < end], False)
@@ -0,0 +1,59 @@
+"""
+Tests for the MPV IPC client, against the local stand-in for MPV from the benchmarks.
+"""
+
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'mpv-utils'))
+
+from benchmark import FakeMPV
+from mpv import MPV
+
+
+class MPVCommandTest(unittest.TestCase):
+	""" Commands should be sent right away, rather than waiting for the IPC thread to wake up on its own. """
+
+	# The amount of commands to time.
+	COMMANDS = 200
+
+	def setUp(self):
+		# The debug logging would otherwise dominate the timings.
+		logging.getLogger().setLevel(logging.WARNING)
+
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		path = os.path.join(directory.name, 'mpv.sock')
+		ready = threading.Event()
+		threading.Thread(target = FakeMPV(path).serve, args = (ready,), daemon = True).start()
+		ready.wait()
+
+		MPV.socket_path = path
+		MPV.socket_read_size = 65536
+		self.mpv = MPV(reconnect = False)
+		self.mpv.start()
+		self.addCleanup(self.mpv.join)
+		self.addCleanup(self.mpv.stop)
+
+	def test_round_trip_with_quiet_server(self):
+		# The server never sends anything on its own, so nothing but the command itself can wake up the IPC thread.
+		timings = []
+		for _ in range(MPVCommandTest.COMMANDS):
+			start = time.perf_counter()
+			self.assertEqual(self.mpv.command('get_property', 'speed'), 1.0)
+			timings.append(time.perf_counter() - start)
+			# Give the IPC thread time to go back to sleep, so that each command has to wake it up.
+			time.sleep(0.001)
+
+		self.assertLess(statistics.median(timings), 0.001)
+		self.assertLess(max(timings), 0.1)
+
+
+if __name__ == '__main__':
+	unittest.main()